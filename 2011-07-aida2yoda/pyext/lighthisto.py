@@ -2,6 +2,11 @@
 # independent, i.e. always use "/" as path delimiter.
 import posixpath
 import os, sys, re, logging
+import struct, mmap, array, tempfile, hashlib
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
 if "ET" not in dir():
     try:
@@ -17,6 +22,13 @@ if "ET" not in dir():
                             " using slower xml.etree.ElementTree instead!")
             import xml.etree.ElementTree as ET
 
+try:
+    import numpy
+except ImportError:
+    logging.debug("Could not load module numpy:"
+                  " histograms will be stored as lists of Bin objects.")
+    numpy = None
+
 
 from htmlentitydefs import codepoint2name
 unichr2entity = {}
@@ -39,6 +51,60 @@ def htmlescape(text, d=None):
     return text
 
 
+def _compilePatterns(patterns):
+    """Compile a list of regex strings, passing compiled regexes through."""
+    return [re.compile(p) for p in (patterns or [])]
+
+
+def _pathSelected(path, patterns, unpatterns):
+    """Check a histogram path against include and exclude regexes."""
+    if patterns and not any(p.search(path) for p in patterns):
+        return False
+    if unpatterns and any(p.search(path) for p in unpatterns):
+        return False
+    return True
+
+
+def iterDPS(source, patterns=None, unpatterns=None):
+    """Iterate over the dataPointSet elements of an AIDA file.
+
+    The file is parsed incrementally with :func:`ET.iterparse` and each
+    element is cleared as soon as the consumer asks for the next one, so
+    only about one histogram is held in memory at a time.
+
+    Parameters
+    ----------
+    source : str or file
+        AIDA file name, '-' for stdin, or an open file object.
+    patterns, unpatterns : list of str or compiled regexes, optional
+        If given, only dataPointSets whose full path (including any
+        leading /REF) matches one of `patterns` and none of `unpatterns`
+        are yielded. Unselected elements are dropped as they are read.
+    """
+    if source == "-":
+        source = sys.stdin
+    patterns = _compilePatterns(patterns)
+    unpatterns = _compilePatterns(unpatterns)
+    root = None
+    skipping = False
+    for event, elem in ET.iterparse(source, events=("start", "end")):
+        if root is None:
+            root = elem
+        if event == "start":
+            if elem.tag == "dataPointSet":
+                fullpath = posixpath.join(elem.get("path", ""), elem.get("name", ""))
+                skipping = not _pathSelected(fullpath, patterns, unpatterns)
+            continue
+        if elem.tag == "dataPointSet":
+            if not skipping:
+                yield elem
+            skipping = False
+            # drop the finished element and its reference from the root
+            root.clear()
+        elif skipping and elem.tag == "dataPoint":
+            elem.clear()
+
+
 # Histo and Bin classes were copied from aida2flat
 
 class Histo(object):
@@ -63,10 +129,24 @@ class Histo(object):
         >>> for b in myhisto:
         ...     # do stuff with Bin b
 
+    If numpy is available, histograms read from files keep their bins in
+    columnar form: one float64 array per entry of :attr:`columnnames`,
+    sorted by bin centre once at construction. :meth:`area`,
+    :meth:`renormalise` and :meth:`chop` then work on whole arrays, and
+    :class:`BinView` objects are only created when bins are requested.
+    Set :attr:`Histo.columnar` to False to always use lists of :class:`Bin`
+    instances instead.
+
     """
     aidaindent = "  "
+    columnnames = ("xlow", "xhigh", "ylow", "yhigh",
+                   "val", "errplus", "errminus", "focus")
+    columnar = numpy is not None
     def __init__(self):
         self._bins = []
+        # parallel float64 arrays keyed by columnnames, if columnar
+        self._cols = None
+        self._views = None
         # the leading AIDA path (including /REF) but not the observable name
         self.path = "/"
         # the observable name, e.g. d01-x02-y01
@@ -185,25 +265,50 @@ class Histo(object):
         return r
 
     def numBins(self):
+        if self._cols is not None:
+            return len(self._cols["xlow"])
         return len(self._bins)
 
+    def isColumnar(self):
+        """True if the bins are stored as parallel numpy arrays."""
+        return self._cols is not None
+
     def getBins(self):
+        if self._cols is not None:
+            if self._views is None:
+                self._views = [BinView(self._cols, i)
+                               for i in xrange(self.numBins())]
+            return self._views
         if not self._sorted:
             self._bins.sort()
             self._sorted = True
         return self._bins
 
     def setBins(self, bins):
+        self._cols = None
+        self._views = None
         self._bins = bins
         self._sorted = False
         return self
 
     def addBin(self, bin):
+        if self._cols is not None:
+            # Appending to the arrays one bin at a time would be quadratic,
+            # so fall back to a list of detached Bin copies.
+            self.setBins([b.copy() for b in self.getBins()])
         self._bins.append(bin)
         self._sorted = False
         return self
 
     def getBin(self, index):
+        if self._cols is not None:
+            if self._views is not None:
+                return self._views[index]
+            if index < 0:
+                index += self.numBins()
+            if not 0 <= index < self.numBins():
+                raise IndexError("bin index out of range")
+            return BinView(self._cols, index)
         if not self._sorted:
             self._bins.sort()
             self._sorted = True
@@ -211,6 +316,89 @@ class Histo(object):
 
     bins = property(getBins, setBins)
 
+    def getColumns(self):
+        """Get the bin contents as a dict of parallel float64 arrays.
+
+        The arrays are keyed by :attr:`columnnames` and sorted by bin
+        centre. Unset values, e.g. ylow and yhigh for 2D data points, are
+        NaN. A histogram that was filled with :meth:`addBin` is converted
+        to columnar storage by this call.
+
+        Raises
+        ------
+        RuntimeError
+            If numpy is not available.
+        """
+        if self._cols is None:
+            if numpy is None:
+                raise RuntimeError("Columnar histogram storage needs numpy!")
+            cols = {}
+            bins = self.getBins()
+            for c in self.columnnames:
+                attr = (c == "focus") and "_focus" or c
+                cols[c] = numpy.array([getattr(b, attr) for b in bins],
+                                      dtype=numpy.float64)
+            self._setColumns(cols)
+        return self._cols
+    columns = property(getColumns)
+
+    def _setColumns(self, cols):
+        """Switch to columnar storage, sorting all columns by bin centre."""
+        nbins = len(cols["xlow"])
+        for c in self.columnnames:
+            if cols.get(c) is None:
+                cols[c] = numpy.empty(nbins, dtype=numpy.float64)
+                cols[c].fill(numpy.nan)
+            else:
+                cols[c] = numpy.asarray(cols[c], dtype=numpy.float64)
+        # A stable sort keeps the file order for bins with equal centres.
+        order = numpy.argsort(cols["xlow"] + cols["xhigh"], kind="mergesort")
+        if (order != numpy.arange(nbins)).any():
+            for c in self.columnnames:
+                cols[c] = cols[c][order]
+        self._cols = cols
+        self._views = None
+        self._bins = None
+        self._sorted = True
+        return self
+
+    @classmethod
+    def fromColumns(cls, xlow, xhigh, val, errplus, errminus,
+                    ylow=None, yhigh=None, focus=None):
+        """Build a columnar histogram from sequences of bin values.
+
+        The sequences are copied and sorted by bin centre. Omitted optional
+        columns are filled with NaN.
+        """
+        new = cls()
+        cols = {"xlow": xlow, "xhigh": xhigh, "val": val,
+                "errplus": errplus, "errminus": errminus,
+                "ylow": ylow, "yhigh": yhigh, "focus": focus}
+        for c, v in cols.items():
+            if v is not None:
+                cols[c] = numpy.array(v, dtype=numpy.float64)
+        return new._setColumns(cols)
+
+    def _fillRows(self, rows):
+        """Fill from (xlow, xhigh, ylow, yhigh, val, errplus, errminus) rows.
+
+        Builds columnar storage if enabled, :class:`Bin` objects otherwise.
+        """
+        if self.columnar and numpy is not None:
+            cols = {}
+            if rows:
+                table = numpy.array(rows, dtype=numpy.float64)
+            else:
+                table = numpy.empty((0, 7), dtype=numpy.float64)
+            for i, c in enumerate(self.columnnames[:7]):
+                cols[c] = table[:, i].copy()
+            self._setColumns(cols)
+        else:
+            for xlow, xhigh, ylow, yhigh, val, errplus, errminus in rows:
+                self.addBin(Bin(xlow, xhigh, val, errplus, errminus,
+                                None, ylow, yhigh))
+        return self
+
     def addAnnotation(self, aname, aval):
         self.annotations[aname] = aval
         return self
@@ -219,6 +407,9 @@ class Histo(object):
         return self.annotations.get(aname)
 
     def area(self):
+        if self._cols is not None:
+            c = self._cols
+            return float(numpy.sum(c["val"] * (c["xhigh"] - c["xlow"])))
         return sum([bin.area() for bin in self.bins])
     getArea = area
 
@@ -226,7 +417,7 @@ class Histo(object):
         return iter(self.getBins())
 
     def __len__(self):
-        return len(self._bins)
+        return self.numBins()
 
     def __getitem__(self, index):
         return self.getBin(index)
@@ -256,6 +447,9 @@ class Histo(object):
         new.xlabel = self.xlabel
         new.ylabel = self.ylabel
 
+        if self._cols is not None:
+            return self._chopColumns(new, xranges)
+
         irange = 0
         curran = xranges[irange]
         for b in self:
@@ -280,6 +474,35 @@ class Histo(object):
                 sys.stderr.write("Chopping bin %s: %e\n" % (self.fullPath(), b.getBinCenter()))
         return new
 
+    def _chopColumns(self, new, xranges):
+        """Vectorised :meth:`chop` for columnar histograms."""
+        cols = self._cols
+        blow, bhigh = cols["xlow"], cols["xhigh"]
+        # Find the range each bin is tested against: like the bin loop in
+        # chop(), step on to the next range once a bin starts beyond the
+        # current range's stop, but never past the last range or a range
+        # with an open stop.
+        stops = []
+        for xr in xranges[:-1]:
+            if xr[1] is None:
+                break
+            stops.append(xr[1])
+        irange = numpy.searchsorted(numpy.array(stops, dtype=numpy.float64),
+                                    blow, side="left")
+        irange = numpy.maximum.accumulate(irange) if len(irange) else irange
+        inf = numpy.inf
+        starts = numpy.array([(xr[0] is None) and -inf or xr[0] for xr in xranges],
+                             dtype=numpy.float64)[irange]
+        ends = numpy.array([(xr[1] is None) and inf or xr[1] for xr in xranges],
+                           dtype=numpy.float64)[irange]
+        lowok = (starts <= blow) | ((blow <= starts) & (starts <= bhigh))
+        highok = (ends >= bhigh) | ((blow <= ends) & (ends <= bhigh))
+        keep = lowok & highok
+        for i in numpy.flatnonzero(~keep):
+            sys.stderr.write("Chopping bin %s: %e\n" % (self.fullPath(),
+                             blow[i] + .5*(bhigh[i] - blow[i])))
+        return new._setColumns(dict((c, v[keep]) for c, v in cols.iteritems()))
+
     def renormalise(self, newarea):
         """ Renormalise histo to newarea """
         # Construc new histo
@@ -294,6 +517,13 @@ class Histo(object):
         # The current histogram area
         oldarea = self.getArea()
 
+        if self._cols is not None:
+            scale = float(newarea) / oldarea
+            cols = dict((c, v.copy()) for c, v in self._cols.iteritems())
+            for c in ("val", "errplus", "errminus"):
+                cols[c] *= scale
+            return new._setColumns(cols)
+
         # Iterate over all bins
         for b in self:
             # Rescale Value, Err+, Err-
@@ -325,28 +555,23 @@ class Histo(object):
                 elif (a.get("dim")=="2"):
                     new.zlabel = a.get("title")
         points = dps.findall("dataPoint")
-        #numbins = len(points)
-        for binnum, point in enumerate(points):
-            bin = Bin()
+        rows = []
+        for point in points:
+            # xlow, xhigh, ylow, yhigh, val, errplus, errminus
+            row = [None, None, None, None, 0., 0., 0.]
             measurements = point.findall("measurement")
             for d, m in enumerate(measurements):
                 val  = float(m.get("value"))
                 down = float(m.get("errorMinus"))
                 up = float(m.get("errorPlus"))
                 if d == 0:
-                    low  = val - down
-                    high = val + up
-                    bin.setXRange(low, high)
+                    row[0:2] = val - down, val + up
                 elif (len(measurements) == 2 and d == 1) or (len(measurements) == 3 and d == 2):
-                    bin.val = val
-                    bin.errplus = up
-                    bin.errminus = down
+                    row[4:7] = val, up, down
                 elif (len(measurements) == 3 and d == 1):
-                    low  = val - down
-                    high = val + up
-                    bin.setYRange(low, high)
-            new.addBin(bin)
-        return new
+                    row[2:4] = val - down, val + up
+            rows.append(row)
+        return new._fillRows(rows)
 
 
     @classmethod
@@ -355,6 +580,7 @@ class Histo(object):
         """
         desc = {}
         new = cls()
+        rows = []
         for line in stringbuf.splitlines():
             line = line.strip()
             if not line:
@@ -374,15 +600,16 @@ class Histo(object):
             else:
                 linearray = line.split()
                 if len(linearray) == 4:
-                    new.addBin(Bin(float(linearray[0]), float(linearray[1]),
-                                   float(linearray[2]),
-                                   float(linearray[3]), float(linearray[3])))
+                    rows.append((float(linearray[0]), float(linearray[1]),
+                                 None, None, float(linearray[2]),
+                                 float(linearray[3]), float(linearray[3])))
                 elif len(linearray) == 5:
-                    new.addBin(Bin(float(linearray[0]), float(linearray[1]),
-                                   float(linearray[2]),
-                                   float(linearray[3]), float(linearray[4])))
+                    rows.append((float(linearray[0]), float(linearray[1]),
+                                 None, None, float(linearray[2]),
+                                 float(linearray[3]), float(linearray[4])))
                 else:
                     sys.stderr.write("Unknown line format in '%s'\n" % line)
+        new._fillRows(rows)
         ## Apply special annotations as histo obj attributes
         if desc.has_key("AidaPath"):
             new.path, new.name = posixpath.split(desc["AidaPath"])
@@ -428,22 +655,55 @@ class Histo(object):
 
 
     @classmethod
-    def fromAIDA(cls, path):
+    def iterAIDA(cls, path, patterns=None, unpatterns=None, cache=False):
+        """Iterate over the histograms in AIDA file 'path'.
+
+        Histograms are built one at a time from a streaming parse, see
+        :func:`iterDPS` for the meaning of the arguments. Unselected
+        dataPointSets are skipped without converting their data points.
+
+        If `cache` is True, the histograms are read from the file's
+        :class:`AIDACache` if it is up to date. Otherwise the whole file is
+        parsed and the cache is (re)written for the next call.
+        """
+        if not cache or path == "-" or not isinstance(path, basestring):
+            for dps in iterDPS(path, patterns, unpatterns):
+                yield cls.fromDPS(dps)
+            return
+        aidacache = AIDACache(path)
+        if aidacache.open():
+            try:
+                for h in aidacache.iterHistos(cls, patterns, unpatterns):
+                    yield h
+            finally:
+                aidacache.close()
+            return
+        histos = list(cls.iterAIDA(path))
+        aidacache.write(histos)
+        patterns = _compilePatterns(patterns)
+        unpatterns = _compilePatterns(unpatterns)
+        for h in histos:
+            if _pathSelected(h.fullpath, patterns, unpatterns):
+                yield h
+
+    @classmethod
+    def fromAIDA(cls, path, patterns=None, unpatterns=None, cache=False):
         """Load all histograms in file 'path' into a histo-path=>histo dict.
 
         The keys of the dictionary are the full paths of the histogram, i.e.
         AnalysisID/HistoID, a leading "/REF" is stripped from the keys.
+        Optional path regexes select histograms and `cache` enables the
+        binary cache as in :meth:`iterAIDA`.
 
         TODO: /REF stripping should really happen in user code...
         """
         runhistos = dict()
-        tree = ET.parse(path)
-        for dps in tree.findall("dataPointSet"):
-            fullpath = posixpath.join(dps.get("path"), dps.get("name"))
+        for h in cls.iterAIDA(path, patterns, unpatterns, cache):
+            fullpath = h.fullpath
             # TODO: Really? Here?
             if fullpath.startswith("/REF"):
                 fullpath = fullpath[4:]
-            runhistos[fullpath] = cls.fromDPS(dps)
+            runhistos[fullpath] = h
         return runhistos
 
 
@@ -470,6 +730,11 @@ class Bin(object):
                 self.val, self.errplus, self.errminus)
         return out
 
+    def copy(self):
+        """Return a detached copy of this bin."""
+        return Bin(self.xlow, self.xhigh, self.val, self.errplus,
+                   self.errminus, self._focus, self.ylow, self.yhigh)
+
     def asFlat(self):
         if self.ylow==None or self.yhigh==None:
             out = "%e\t%e\t%e\t%e\t%e" % (self.xlow, self.xhigh, self.val, self.errminus, self.errplus)
@@ -497,7 +762,7 @@ class Bin(object):
 
     def __cmp__(self, other):
         """Sort by mean x value (yeah, I know...)"""
-        return (self.xlow + self.xhigh) > (other.xlow + other.xhigh)
+        return cmp(self.xlow + self.xhigh, other.xlow + other.xhigh)
 
     def getXRange(self):
         return (self.xlow, self.xhigh)
@@ -548,6 +813,560 @@ class Bin(object):
     err = property(getErr, setErr)
 
 
+def _columnProperty(column):
+    """Property reading and writing one column entry of a BinView."""
+    def fget(self):
+        v = self._cols[column][self._index]
+        # NaN marks an unset value
+        if v != v:
+            return None
+        return float(v)
+    def fset(self, value):
+        if value is None:
+            value = numpy.nan
+        self._cols[column][self._index] = value
+    return property(fget, fset)
+
+
+class BinView(Bin):
+    """A :class:`Bin` whose values live in the columns of a :class:`Histo`.
+
+    Reading and assigning attributes goes straight to the histogram's
+    arrays, so changes made through a view are seen by the histogram.
+    """
+    __slots__ = ["_cols", "_index"]
+    def __init__(self, cols, index):
+        self._cols = cols
+        self._index = index
+
+    xlow = _columnProperty("xlow")
+    xhigh = _columnProperty("xhigh")
+    ylow = _columnProperty("ylow")
+    yhigh = _columnProperty("yhigh")
+    val = _columnProperty("val")
+    errplus = _columnProperty("errplus")
+    errminus = _columnProperty("errminus")
+    _focus = _columnProperty("focus")
+
+
+def _nanToNone(v):
+    if v != v:
+        return None
+    return v
+
+
+def _noneToNan(v):
+    if v is None:
+        return float("nan")
+    return v
+
+
+class AIDACache(object):
+    """Binary cache of the histograms in an AIDA file.
+
+    The cache file consists of a fixed-size header, an index with one
+    fixed-size record per histogram, a table of the path, name, title and
+    axis label strings, and one block of packed little-endian float64 bin
+    columns (see :attr:`Histo.columnnames`) per histogram. The header
+    records the mtime and size of the AIDA file, and a cache that doesn't
+    match them is ignored. Cache files are read through :mod:`mmap`, so
+    :meth:`getHisto` only reads the bytes of the histogram asked for.
+
+    The cache is stored next to the AIDA file as ``<file>.lhcache`` if
+    possible, and in :attr:`cachedir` (``$LIGHTHISTO_CACHEDIR`` or
+    ``~/.lighthisto``) otherwise, e.g. for read-only reference data.
+
+    Example:
+        >>> c = AIDACache("ATLAS_2010_S8918562.aida")
+        >>> if not c.open():
+        ...     c.write(Histo.iterAIDA(c.aidapath))
+        ...     c.open()
+        >>> h = c.getHisto("/REF/ATLAS_2010_S8918562/d01-x01-y01")
+    """
+    magic = "LHCACHE1"
+    version = 2
+    suffix = ".lhcache"
+    cachedir = os.environ.get("LIGHTHISTO_CACHEDIR",
+                              os.path.join(os.path.expanduser("~"), ".lighthisto"))
+    # magic, version, number of histos, source mtime, source size,
+    # string table offset
+    _header = struct.Struct("<8sIIdQQ")
+    # path, name, title, xlabel, ylabel and zlabel string indices, number
+    # of bins, offset of the bin data
+    _entry = struct.Struct("<6IIQ")
+    _nostring = 0xffffffff
+
+    def __init__(self, aidapath):
+        self.aidapath = os.path.abspath(aidapath)
+        self._mm = None
+        self._entries = None
+        self._byPath = None
+
+    def cachePaths(self):
+        """The sidecar cache path and the fallback path in :attr:`cachedir`."""
+        sidecar = self.aidapath + self.suffix
+        key = hashlib.md5(self.aidapath).hexdigest()[:12]
+        fallback = os.path.join(self.cachedir, "%s-%s%s" % (
+                os.path.basename(self.aidapath), key, self.suffix))
+        return sidecar, fallback
+
+    def _sourceKey(self):
+        st = os.stat(self.aidapath)
+        return st.st_mtime, st.st_size
+
+    def open(self):
+        """Map the first up-to-date cache file.
+
+        Returns
+        -------
+        success : bool
+            False if there is no cache matching the AIDA file.
+        """
+        if self._mm is not None:
+            return True
+        try:
+            mtime, size = self._sourceKey()
+        except OSError:
+            return False
+        for cpath in self.cachePaths():
+            try:
+                f = open(cpath, "rb")
+            except IOError:
+                continue
+            try:
+                try:
+                    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except (mmap.error, ValueError):
+                    continue
+            finally:
+                f.close()
+            if len(mm) < self._header.size:
+                mm.close()
+                continue
+            magic, version, nhistos, cmtime, csize, stroffset = \
+                self._header.unpack_from(mm, 0)
+            if (magic, version, cmtime, csize) != (self.magic, self.version, mtime, size):
+                logging.debug("Ignoring stale histogram cache %s" % cpath)
+                mm.close()
+                continue
+            self._mm = mm
+            self._readIndex(nhistos, stroffset)
+            return True
+        return False
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+        self._mm = None
+        self._entries = None
+        self._byPath = None
+
+    def _readIndex(self, nhistos, stroffset):
+        mm = self._mm
+        nstrings = struct.unpack_from("<I", mm, stroffset)[0]
+        pos = stroffset + 4
+        strings = []
+        for i in xrange(nstrings):
+            n = struct.unpack_from("<I", mm, pos)[0]
+            raw = mm[pos+4:pos+4+n].decode("utf-8")
+            # plain str for ASCII, like ElementTree
+            try:
+                raw = str(raw)
+            except UnicodeEncodeError:
+                pass
+            strings.append(raw)
+            pos += 4 + n
+        self._entries = []
+        self._byPath = {}
+        for i in xrange(nhistos):
+            entry = self._entry.unpack_from(mm, self._header.size + i*self._entry.size)
+            meta = [None] * 6
+            for j, sid in enumerate(entry[:6]):
+                if sid != self._nostring:
+                    meta[j] = strings[sid]
+            record = (meta, entry[6], entry[7])
+            self._entries.append(record)
+            self._byPath[posixpath.join(meta[0] or "", meta[1] or "")] = record
+
+    def getPaths(self):
+        """Full paths of the cached histograms, in file order."""
+        return [posixpath.join(m[0] or "", m[1] or "") for m, n, o in self._entries]
+
+    def getHisto(self, fullpath, cls=None):
+        """Get a single histogram by full path (including any /REF), or None."""
+        record = self._byPath.get(fullpath)
+        if record is None:
+            return None
+        return self._makeHisto(cls or Histo, *record)
+
+    def iterHistos(self, cls=None, patterns=None, unpatterns=None):
+        """Iterate over the cached histograms, optionally selected by path."""
+        patterns = _compilePatterns(patterns)
+        unpatterns = _compilePatterns(unpatterns)
+        for meta, nbins, offset in self._entries:
+            if _pathSelected(posixpath.join(meta[0] or "", meta[1] or ""),
+                             patterns, unpatterns):
+                yield self._makeHisto(cls or Histo, meta, nbins, offset)
+
+    def _makeHisto(self, cls, meta, nbins, offset):
+        new = cls()
+        new.path, new.name, new.title, new.xlabel, new.ylabel = meta[:5]
+        # only 3D dataPointSets have a zlabel, see fromDPS
+        if meta[5] is not None:
+            new.zlabel = meta[5]
+        ncols = len(cls.columnnames)
+        if cls.columnar and numpy is not None:
+            data = numpy.frombuffer(self._mm, dtype="<f8",
+                                    count=ncols*nbins, offset=offset)
+            data = data.reshape(ncols, nbins).astype(numpy.float64)
+            new._setColumns(dict(zip(cls.columnnames, data)))
+        else:
+            values = struct.unpack_from("<%dd" % (ncols*nbins), self._mm, offset)
+            cols = [map(_nanToNone, values[i*nbins:(i+1)*nbins])
+                    for i in xrange(7)]
+            new._fillRows(zip(*cols))
+        return new
+
+    def _packColumns(self, h):
+        if h.isColumnar():
+            cols = h.getColumns()
+            return numpy.vstack([cols[c] for c in h.columnnames]).astype("<f8").tostring()
+        bins = h.getBins()
+        values = []
+        for c in h.columnnames:
+            attr = (c == "focus") and "_focus" or c
+            values.extend([_noneToNan(getattr(b, attr)) for b in bins])
+        data = array.array("d", values)
+        if sys.byteorder == "big":
+            data.byteswap()
+        return data.tostring()
+
+    def write(self, histos):
+        """Write histos to the cache, tied to the current AIDA file state.
+
+        Returns
+        -------
+        cachepath : str or None
+            The written cache file, or None if no location was writable.
+        """
+        self.close()
+        mtime, size = self._sourceKey()
+        strings, stringids = [], {}
+        def stringid(s):
+            if s is None:
+                return self._nostring
+            if s not in stringids:
+                stringids[s] = len(strings)
+                strings.append(s)
+            return stringids[s]
+        histos = [(h, [stringid(v) for v in (h.path, h.name, h.title, h.xlabel, h.ylabel,
+                                              getattr(h, "zlabel", None))])
+                  for h in histos]
+
+        strtab = [struct.pack("<I", len(strings))]
+        for s in strings:
+            raw = s.encode("utf-8")
+            strtab.append(struct.pack("<I", len(raw)))
+            strtab.append(raw)
+        strtab = "".join(strtab)
+        stroffset = self._header.size + len(histos)*self._entry.size
+        # keep the float64 blocks 8-byte aligned
+        padding = "\0" * (-(stroffset + len(strtab)) % 8)
+        offset = stroffset + len(strtab) + len(padding)
+        index, blocks = [], []
+        for h, ids in histos:
+            block = self._packColumns(h)
+            index.append(self._entry.pack(*(ids + [h.numBins(), offset])))
+            blocks.append(block)
+            offset += len(block)
+        header = self._header.pack(self.magic, self.version, len(histos),
+                                   mtime, size, stroffset)
+        chunks = [header] + index + [strtab, padding] + blocks
+
+        for cpath in self.cachePaths():
+            if _writeAtomically(cpath, chunks):
+                logging.debug("Wrote histogram cache %s" % cpath)
+                return cpath
+        logging.debug("Could not write a histogram cache for %s" % self.aidapath)
+        return None
+
+
+def _writeAtomically(path, chunks):
+    """Write chunks to a temp file and rename it to path.
+
+    Returns False if the file could not be written.
+    """
+    dirname = os.path.dirname(path)
+    tmppath = None
+    try:
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        fd, tmppath = tempfile.mkstemp(dir=dirname, suffix=".tmp",
+                                       prefix="." + os.path.basename(path))
+        f = os.fdopen(fd, "wb")
+        try:
+            for c in chunks:
+                f.write(c)
+        finally:
+            f.close()
+        os.rename(tmppath, path)
+        return True
+    except (IOError, OSError):
+        if tmppath is not None and os.path.exists(tmppath):
+            os.remove(tmppath)
+        return False
+
+
+class RefIndex(object):
+    """Persistent histogram path -> file -> byte offset index of AIDA files.
+
+    The index covers all .aida files in a list of (reference data)
+    directories, e.g. :func:`rivet.getAnalysisRefPaths`, and maps each
+    analysis to the files containing its histograms, and each histogram
+    full path to the byte range of its dataPointSet. Tools can then load
+    only the files of the analyses they need, or pull out single
+    histograms without parsing the rest of a file.
+
+    The index is stored in :attr:`AIDACache.cachedir` and files are only
+    rescanned when their mtime or size has changed.
+
+    Example:
+        >>> idx = RefIndex(rivet.getAnalysisRefPaths())
+        >>> reffiles = idx.getFiles(["ATLAS_2010_S8918562"])
+        >>> h = idx.getHisto("/REF/ATLAS_2010_S8918562/d01-x01-y01")
+    """
+    version = 1
+    pat_dps_begin = re.compile(r'<dataPointSet\b([^>]*)>')
+    pat_dps_end = re.compile(r'</dataPointSet\s*>')
+    pat_attr = re.compile(r'(\w+)\s*=\s*"([^"]*)"')
+
+    def __init__(self, refdirs, indexfile=None):
+        """
+        Parameters
+        ----------
+        refdirs : list of str
+            Directories to index the .aida files of.
+        indexfile : str, optional
+            Where to store the index. The default is a file in
+            :attr:`AIDACache.cachedir` named after the directory list.
+        """
+        self.refdirs = [os.path.abspath(d) for d in refdirs]
+        if indexfile is None:
+            key = hashlib.md5("\n".join(self.refdirs)).hexdigest()[:12]
+            indexfile = os.path.join(AIDACache.cachedir, "refindex-%s.pickle" % key)
+        self.indexfile = indexfile
+        # aidapath => (mtime, size, [(fullpath, offset, length), ...])
+        self._files = {}
+        self._load()
+        self.update()
+
+    def _load(self):
+        try:
+            f = open(self.indexfile, "rb")
+        except IOError:
+            return
+        try:
+            try:
+                version, files = pickle.load(f)
+                if version == self.version:
+                    self._files = files
+            except Exception, e:
+                logging.debug("Ignoring unreadable index %s: %s" % (self.indexfile, e))
+        finally:
+            f.close()
+
+    def update(self):
+        """Rescan new and changed files and drop removed ones.
+
+        The index file is rewritten if anything changed.
+        """
+        changed = False
+        seen = set()
+        for d in self.refdirs:
+            try:
+                names = sorted(os.listdir(d))
+            except OSError:
+                continue
+            for name in names:
+                if not name.endswith(".aida"):
+                    continue
+                aidapath = os.path.join(d, name)
+                try:
+                    st = os.stat(aidapath)
+                except OSError:
+                    continue
+                seen.add(aidapath)
+                old = self._files.get(aidapath)
+                if old is None or old[:2] != (st.st_mtime, st.st_size):
+                    self._files[aidapath] = (st.st_mtime, st.st_size,
+                                             self._scan(aidapath))
+                    changed = True
+        for aidapath in self._files.keys():
+            if aidapath not in seen:
+                del self._files[aidapath]
+                changed = True
+        if changed:
+            chunk = pickle.dumps((self.version, self._files), pickle.HIGHEST_PROTOCOL)
+            if not _writeAtomically(self.indexfile, [chunk]):
+                logging.debug("Could not write reference index %s" % self.indexfile)
+        self._buildLookups()
+
+    def _scan(self, aidapath):
+        """Find the byte range of every dataPointSet in an AIDA file."""
+        entries = []
+        f = open(aidapath, "rb")
+        try:
+            try:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (mmap.error, ValueError):
+                return entries
+            try:
+                pos = 0
+                while True:
+                    mb = self.pat_dps_begin.search(data, pos)
+                    if mb is None:
+                        break
+                    me = self.pat_dps_end.search(data, mb.end())
+                    if me is None:
+                        break
+                    attrs = dict(self.pat_attr.findall(mb.group(1)))
+                    fullpath = posixpath.join(attrs.get("path", ""), attrs.get("name", ""))
+                    entries.append((fullpath, mb.start(), me.end() - mb.start()))
+                    pos = me.end()
+            finally:
+                data.close()
+        finally:
+            f.close()
+        return entries
+
+    def _buildLookups(self):
+        self._byPath = {}
+        self._byAnalysis = {}
+        for aidapath in sorted(self._files):
+            for fullpath, offset, length in self._files[aidapath][2]:
+                self._byPath.setdefault(fullpath, (aidapath, offset, length))
+                ana = analysisName(fullpath)
+                files = self._byAnalysis.setdefault(ana, [])
+                if aidapath not in files:
+                    files.append(aidapath)
+
+    def getAnalyses(self):
+        """Names of all analyses with indexed histograms."""
+        return set(self._byAnalysis.keys())
+
+    def getFiles(self, analyses=None):
+        """Files containing histograms of the given analyses (default: all)."""
+        if analyses is None:
+            return sorted(self._files.keys())
+        files = []
+        for ana in analyses:
+            for aidapath in self._byAnalysis.get(ana, []):
+                if aidapath not in files:
+                    files.append(aidapath)
+        return files
+
+    def getPaths(self, analysis=None):
+        """Full paths of the indexed histograms, optionally for one analysis."""
+        return sorted(p for p in self._byPath
+                      if analysis is None or analysisName(p) == analysis)
+
+    def getHisto(self, fullpath, cls=None):
+        """Parse a single histogram by full path (including any /REF), or None."""
+        loc = self._byPath.get(fullpath)
+        if loc is None:
+            return None
+        aidapath, offset, length = loc
+        f = open(aidapath, "rb")
+        try:
+            f.seek(offset)
+            chunk = f.read(length)
+        finally:
+            f.close()
+        return (cls or Histo).fromDPS(ET.fromstring(chunk))
+
+
+def analysisName(fullpath):
+    """Get the analysis name from a histogram path like /REF/ANALYSIS/d01-x01-y01."""
+    parts = [p for p in fullpath.split("/") if p]
+    if parts and parts[0] == "REF":
+        parts = parts[1:]
+    if not parts:
+        return None
+    return parts[0]
+
+
+def mergeAIDA(parts, outpath):
+    """Merge the histograms of several AIDA files into one file.
+
+    Every bin is the average of the bins of the files, weighted by the
+    weights of the files, and the errors are combined in quadrature with the
+    same weights. This is what a single run over all the events gives for
+    histograms that are normalised or scaled by cross-section / sum of
+    weights, the usual finalize of an analysis. Histograms left as raw sums
+    of weights should be summed instead, and come out scaled down by the
+    number of files.
+
+    Histograms are matched by full path, and a histogram whose bins don't
+    match those of the first file it is in is skipped with a warning.
+
+    Parameters
+    ----------
+    parts : list of (str, float)
+        The AIDA files and their weights, e.g. their numbers of events or
+        sums of event weights.
+    outpath : str
+        The merged AIDA file, written through a temporary file.
+
+    Returns
+    -------
+    nhistos : int
+        The number of merged histograms.
+
+    Raises
+    ------
+    IOError
+        If the merged file could not be written.
+    """
+    if numpy is None:
+        raise RuntimeError("Merging histograms needs numpy!")
+    paths, sums = [], {}
+    for aidapath, weight in parts:
+        weight = float(weight)
+        for h in Histo.iterAIDA(aidapath):
+            cols = h.getColumns()
+            s = sums.get(h.fullpath)
+            if s is None:
+                paths.append(h.fullpath)
+                nbins = h.numBins()
+                s = sums[h.fullpath] = [h, 0.0, numpy.zeros(nbins),
+                                        numpy.zeros(nbins), numpy.zeros(nbins)]
+            if h.numBins() != s[0].numBins():
+                logging.warning("Skipping %s in %s: its bins do not match" % (h.fullpath, aidapath))
+                continue
+            s[1] += weight
+            s[2] += weight * cols["val"]
+            s[3] += (weight * cols["errplus"])**2
+            s[4] += (weight * cols["errminus"])**2
+
+    chunks = ['<?xml version="1.0" encoding="UTF-8"?>\n',
+              '<!DOCTYPE aida SYSTEM "http://aida.freehep.org/schemas/3.3/aida.dtd">\n',
+              '<aida version="3.3">\n']
+    for path in paths:
+        template, sumw, val, errplus2, errminus2 = sums[path]
+        cols = template.getColumns()
+        h = Histo.fromColumns(cols["xlow"], cols["xhigh"], val / sumw,
+                              numpy.sqrt(errplus2) / sumw, numpy.sqrt(errminus2) / sumw)
+        h.path, h.name = template.path, template.name
+        h.title, h.xlabel, h.ylabel = template.title, template.xlabel, template.ylabel
+        chunks.append(h.asAIDA())
+    chunks.append("</aida>\n")
+    if not _writeAtomically(os.path.abspath(outpath), chunks):
+        raise IOError("Could not write the merged histograms to %s" % outpath)
+    # mkstemp makes the file private
+    os.chmod(outpath, 0644)
+    return len(paths)
+
+
 class PlotParser(object):
     """Parser for Rivet's .plot plot info files."""
     pat_begin_block = re.compile('^#+ BEGIN ([A-Z0-9_]+) ?(\S+)?')
@@ -590,23 +1409,23 @@ class PlotParser(object):
             except ImportError, e:
                 sys.stderr.write("Failed to import rivet module: %s\n" % e)
                 raise ValueError("No plot paths given and the rivet module could not be loaded!")
+        # .plot file path -> (mtime, size, index), see getPlotIndex
+        self.plotindex = {}
 
 
     def getSection(self, section, hpath):
         """Get a section for a histogram from a .plot file.
 
+        Every .plot file is parsed once into an index (see
+        :meth:`getPlotIndex`), which is only re-read when the file changes.
+        Lookups are then answered from memory.
+
         Parameters
         ----------
         section : ('PLOT'|'SPECIAL'|'HISTOGRAM')
             The section that should be extracted.
         hpath : str
             The histogram path, i.e. /AnaylsisID/HistogramID .
-
-        Todo
-        ----
-        Caching!
-            At the moment the result of the lookup is not cached so every
-            call requires a file to be searched for and opened.
         """
         if section not in ['PLOT', 'SPECIAL', 'HISTOGRAM']:
             raise ValueError("Can't parse section \'%s\'" %section)
@@ -617,40 +1436,107 @@ class PlotParser(object):
         base = parts[1] + ".plot"
         ret = {'PLOT': {}, 'SPECIAL': None, 'HISTOGRAM': {}}
         for pidir in self.plotpaths:
-            plotfile = os.path.join(pidir, base)
-            if os.access(plotfile, os.R_OK):
-                #print plotfile
-                startreading = False
-                f = open(plotfile)
-                for line in f:
-                    m = self.pat_begin_block.match(line)
-                    if m:
-                        tag, pathpat = m.group(1,2)
-                        # pathpat could be a regex
-                        if tag == section and re.match(pathpat,hpath):
-                            startreading = True
-                            if section in ['SPECIAL']:
-                                ret[section] = ''
-                            continue
-                    if not startreading:
-                        continue
-                    if self.isEndMarker(line, section):
-                        startreading = False
-                        continue
-                    elif self.isComment(line):
-                        continue
+            index = self.getPlotIndex(os.path.join(pidir, base))
+            if index is None:
+                continue
+            startreading = False
+            for pathpat, ended, props, special in index[section]:
+                if pathpat is not None and pathpat.match(hpath):
+                    startreading = True
+                    if section in ['SPECIAL']:
+                        ret[section] = ''
+                if startreading:
                     if section in ['PLOT', 'HISTOGRAM']:
-                        vm = self.pat_property.match(line)
-                        if vm:
-                            prop, value = vm.group(1,2)
-                            #print prop, value
-                            ret[section][prop] = value
+                        ret[section].update(props)
                     elif section in ['SPECIAL']:
-                        ret[section] += line
-                f.close()
-                # no break, as we can collect settings from multiple .plot files
+                        ret[section] += special
+                if ended:
+                    startreading = False
+            # no break, as we can collect settings from multiple .plot files
         return ret[section]
 
+    def getPlotIndex(self, plotfile):
+        """Get the index of a .plot file, parsing it if it is new or has
+        changed since it was last parsed.
+
+        Parameters
+        ----------
+        plotfile : str
+            Path of the .plot file.
+
+        Returns
+        -------
+        index : dict or None
+            None if `plotfile` can't be read. Otherwise the index maps each
+            section name to the list of its blocks, in file order, as
+            ``(pathpat, ended, props, special)``: the compiled path pattern
+            of the BEGIN line (None if it has none), whether the block is
+            closed by an END line of its section rather than by the next
+            BEGIN of it, the properties of the block as a list of
+            ``(prop, value)`` and the text of the block for SPECIAL.
+        """
+        try:
+            st = os.stat(plotfile)
+        except OSError:
+            self.plotindex.pop(plotfile, None)
+            return None
+        cached = self.plotindex.get(plotfile)
+        if cached is not None and cached[:2] == (st.st_mtime, st.st_size):
+            return cached[2]
+        if not os.access(plotfile, os.R_OK):
+            return None
+        f = open(plotfile)
+        try:
+            index = self.parsePlotFile(f)
+        finally:
+            f.close()
+        self.plotindex[plotfile] = (st.st_mtime, st.st_size, index)
+        return index
+
+    def parsePlotFile(self, lines):
+        """Parse the lines of a .plot file into an index, see
+        :meth:`getPlotIndex`.
+
+        A block of a section runs from its BEGIN line to the next BEGIN or
+        END line of the same section, so that a block without an END line
+        carries on into the next one just as it does for a line by line
+        reading of the file.
+        """
+        index = {'PLOT': [], 'SPECIAL': [], 'HISTOGRAM': []}
+        # the open block of each section, [pathpat, ended, props, special]
+        current = {}
+        for line in lines:
+            m = self.pat_begin_block.match(line)
+            if m:
+                tag, pathpat = m.group(1,2)
+                if tag in index:
+                    if pathpat is not None:
+                        # pathpat could be a regex
+                        try:
+                            pathpat = re.compile(pathpat)
+                        except re.error, e:
+                            logging.warning("Ignoring block with bad path pattern"
+                                            " '%s': %s" % (pathpat, e))
+                            pathpat = None
+                    current[tag] = [pathpat, False, [], '']
+                    index[tag].append(current[tag])
+                continue
+            m = self.pat_end_block.match(line)
+            if m and current.has_key(m.group(1)):
+                current.pop(m.group(1))[1] = True
+                continue
+            if self.isComment(line):
+                continue
+            vm = self.pat_property.match(line)
+            for tag, block in current.iteritems():
+                if tag in ['PLOT', 'HISTOGRAM']:
+                    if vm:
+                        block[2].append(vm.group(1,2))
+                else:
+                    block[3] += line
+        for tag in index:
+            index[tag] = [tuple(block) for block in index[tag]]
+        return index
 
     def getHeaders(self, hpath):
         """Get the plot headers for histogram hpath.
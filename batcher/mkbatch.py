@@ -1,4 +1,21 @@
+"""
+%prog [options]
+
+Makes the run directories of a Professor parameter scan, one per point, with
+the used_params, agileparams.params and batch.sh files of the run. The points
+fill the parameter ranges with a Latin hypercube (lhs), a Sobol sequence
+(sobol) or independent uniform draws (uniform), from a fixed seed.
+
+All the points of the scan are listed in MASTER_BATCH_DIR/manifest.json.
+With --append new points are added to an existing scan: a Sobol scan
+carries on with its sequence, the other methods draw a new batch with the
+next seed.
+
+The parameter ranges file has lines 'NAME LOW HIGH'.
+"""
+
 import random
+import json
 import os
 import os.path
 
@@ -7,6 +24,34 @@ MASTER_BATCH_DIR = os.path.join(HOME_DIR, 'mc')
 
 base_params = ''
 
+# The parameters and their ranges when no ranges file is given
+DEFAULT_RANGES = [('PMAS(2212,1)', 0.5, 2.0),
+                  ('PARP(67)', 0.5, 2.0)]
+
+# Bits of precision of the Sobol points
+SOBOL_BITS = 30
+
+# Degree s, coefficients a and initial direction numbers m of the primitive
+# polynomials for the Sobol dimensions after the first one, from the
+# new-joe-kuo-6.21201 table of S. Joe and F. Y. Kuo
+SOBOL_POLYNOMIALS = [
+    (1, 0, [1]),
+    (2, 1, [1, 3]),
+    (3, 1, [1, 3, 1]),
+    (3, 2, [1, 1, 1]),
+    (4, 1, [1, 1, 3, 3]),
+    (4, 4, [1, 3, 5, 13]),
+    (5, 2, [1, 1, 5, 5, 17]),
+    (5, 4, [1, 1, 5, 5, 5]),
+    (5, 7, [1, 1, 7, 11, 19]),
+    (5, 11, [1, 1, 5, 1, 1]),
+    (5, 13, [1, 1, 1, 3, 11]),
+    (5, 14, [1, 3, 5, 5, 31]),
+    (6, 1, [1, 3, 3, 9, 7, 49]),
+    (6, 13, [1, 1, 1, 15, 21, 21]),
+    (6, 16, [1, 3, 1, 13, 27, 49]),
+]
+
 def batch_script(batchdir, n):
     return '\n'.join(
         ['#!/bin/sh',
@@ -15,35 +60,177 @@ def batch_script(batchdir, n):
          'make-rivet ATLAS_2010_S8918562 -n 50000 -P agileparams.params -o\
          out.aida --prefix rivet-%s --beams LHC:7T' % n])
 
-try:
-    os.mkdir(MASTER_BATCH_DIR)
-except Exception, e:
-    pass
+def read_ranges(filename):
+    """[(name, low, high)] from a parameter ranges file"""
+    ranges = []
+    with open(filename, 'r') as f:
+        for line in f:
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            if len(fields) != 3:
+                raise ValueError("%s: expected 'NAME LOW HIGH', got '%s'" % (filename, line.strip()))
+            ranges.append((fields[0], float(fields[1]), float(fields[2])))
+    return ranges
+
+def sobol_directions(ndim):
+    """Direction numbers of the first ndim Sobol dimensions"""
+    if ndim > len(SOBOL_POLYNOMIALS) + 1:
+        raise ValueError('Sobol sequences are only set up for up to %d parameters'
+                         % (len(SOBOL_POLYNOMIALS) + 1))
+    directions = [[1 << (SOBOL_BITS - k - 1) for k in xrange(SOBOL_BITS)]]
+    for s, a, m in SOBOL_POLYNOMIALS[:ndim - 1]:
+        v = [0] * SOBOL_BITS
+        for k in xrange(s):
+            v[k] = m[k] << (SOBOL_BITS - k - 1)
+        for k in xrange(s, SOBOL_BITS):
+            v[k] = v[k - s] ^ (v[k - s] >> s)
+            for j in xrange(1, s):
+                if (a >> (s - 1 - j)) & 1:
+                    v[k] ^= v[k - j]
+        directions.append(v)
+    return directions
+
+def sobol_points(ndim, first, n, seed):
+    """Points first .. first+n-1 of a Sobol sequence in the unit cube, with
+    a random digital shift from seed, which keeps the sequence's uniformity"""
+    directions = sobol_directions(ndim)
+    rng = random.Random(seed)
+    shifts = [rng.getrandbits(SOBOL_BITS) for d in xrange(ndim)]
+    points = []
+    for i in xrange(first, first + n):
+        point = []
+        for v, shift in zip(directions, shifts):
+            x, bits, k = shift, i, 0
+            while bits:
+                if bits & 1:
+                    x ^= v[k]
+                bits >>= 1
+                k += 1
+            point.append(float(x) / (1 << SOBOL_BITS))
+        points.append(point)
+    return points
 
+def lhs_points(ndim, n, seed):
+    """Latin hypercube of n points in the unit cube: every parameter has
+    one point in each of its n equal strata"""
+    rng = random.Random(seed)
+    columns = []
+    for d in xrange(ndim):
+        strata = range(n)
+        rng.shuffle(strata)
+        columns.append([(s + rng.random()) / n for s in strata])
+    return [list(point) for point in zip(*columns)]
 
+def uniform_points(ndim, n, seed):
+    rng = random.Random(seed)
+    return [[rng.random() for d in xrange(ndim)] for i in xrange(n)]
 
-for x in xrange(250):
-    batchname = '%03d' % x
+def scale(point, ranges):
+    return dict((name, low + x * (high - low)) for x, (name, low, high) in zip(point, ranges))
 
-    batchdir = os.path.join(MASTER_BATCH_DIR, batchname)
-    paramfile = os.path.join(batchdir, 'used_params')
-    bigparamfile = os.path.join(batchdir, 'agileparams.params')
-    batchfile = os.path.join(batchdir, 'batch.sh')
+def new_points(manifest, n):
+    """n new points of the scan, in the parameter ranges, and update the
+    state of the sampling in the manifest"""
+    ndim = len(manifest['ranges'])
+    method, seed = manifest['method'], manifest['seed']
+    if method == 'sobol':
+        points = sobol_points(ndim, manifest['sequence'], n, seed)
+        manifest['sequence'] += n
+    else:
+        # Every batch of points gets its own seed, derived from the scan's
+        batchseed = seed * 1000003 + manifest['batches']
+        if method == 'lhs':
+            points = lhs_points(ndim, n, batchseed)
+        else:
+            points = uniform_points(ndim, n, batchseed)
+    manifest['batches'] += 1
+    return [scale(point, manifest['ranges']) for point in points]
+
+def write_file(path, text, mode=0644):
+    with open(path, 'w') as f:
+        f.write(text)
+    os.chmod(path, mode)
+
+def write_manifest(manifest, path):
+    with open(path + '.swp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.rename(path + '.swp', path)
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser(usage=__doc__)
+    parser.add_option('-n', '--number', dest='NUMBER', type='int', default=250,
+            help='Number of points to make. Default: 250')
+    parser.add_option('-m', '--method', dest='METHOD', default=None,
+            choices=['lhs', 'sobol', 'uniform'],
+            help='Sampling method, lhs, sobol or uniform. Default: lhs')
+    parser.add_option('-s', '--seed', dest='SEED', type='int', default=None,
+            help='Seed of the scan. Default: 0')
+    parser.add_option('-r', '--ranges', dest='RANGES', default=None,
+            help="Parameter ranges file, with lines 'NAME LOW HIGH'")
+    parser.add_option('-a', '--append', dest='APPEND', action='store_true', default=False,
+            help='Add the points to the existing scan')
+    parser.add_option('-d', '--dir', dest='DIR', default=MASTER_BATCH_DIR,
+            help='Directory of the scan. Default: %default')
+    (opts, args) = parser.parse_args()
+
+    MASTER_BATCH_DIR = opts.DIR
+    manifestfile = os.path.join(MASTER_BATCH_DIR, 'manifest.json')
 
     try:
-        os.mkdir(batchdir)
+        os.mkdir(MASTER_BATCH_DIR)
     except Exception, e:
         pass
 
-    params = {'PMAS(2212,1)' : random.uniform(0.5, 2.0),
-              'PARP(67)'  : random.uniform(0.5, 2.0)}
-    param_text = '\n'.join('%s %s' % i for i in params.iteritems())
+    if os.path.exists(manifestfile):
+        if not opts.APPEND:
+            parser.error('%s exists already, use --append to add points to the scan' % manifestfile)
+        with open(manifestfile, 'r') as f:
+            manifest = json.load(f)
+        # The sampling carries on as it was set up for the scan
+        manifest['ranges'] = [tuple(r) for r in manifest['ranges']]
+        if opts.METHOD is not None and opts.METHOD != manifest['method']:
+            parser.error('the scan uses the %s method, not %s' % (manifest['method'], opts.METHOD))
+        if opts.SEED is not None and opts.SEED != manifest['seed']:
+            parser.error('the scan has seed %d, not %d' % (manifest['seed'], opts.SEED))
+        if opts.RANGES and read_ranges(opts.RANGES) != manifest['ranges']:
+            parser.error('the ranges in %s are not those of the scan' % opts.RANGES)
+    else:
+        # Run directories from before the manifests would be overwritten
+        rundirs = [name for name in os.listdir(MASTER_BATCH_DIR)
+                   if name.isdigit() and os.path.isdir(os.path.join(MASTER_BATCH_DIR, name))]
+        if rundirs:
+            parser.error('%s has run directories but no manifest.json, use an empty directory'
+                         % MASTER_BATCH_DIR)
+        if opts.RANGES:
+            ranges = read_ranges(opts.RANGES)
+        else:
+            ranges = DEFAULT_RANGES
+        manifest = {'method': opts.METHOD or 'lhs', 'seed': opts.SEED or 0, 'ranges': ranges,
+                    'sequence': 0, 'batches': 0, 'points': []}
+
+    first = len(manifest['points'])
+    for x, params in enumerate(new_points(manifest, opts.NUMBER)):
+        batchname = '%03d' % (first + x)
+
+        batchdir = os.path.join(MASTER_BATCH_DIR, batchname)
+        paramfile = os.path.join(batchdir, 'used_params')
+        bigparamfile = os.path.join(batchdir, 'agileparams.params')
+        batchfile = os.path.join(batchdir, 'batch.sh')
+
+        try:
+            os.mkdir(batchdir)
+        except Exception, e:
+            pass
+
+        param_text = '\n'.join('%s %r' % (name, params[name]) for name, low, high in manifest['ranges'])
 
-    with open(paramfile, 'w') as f:
-        f.write(param_text)
+        write_file(paramfile, param_text)
+        write_file(batchfile, batch_script(batchdir, batchname), 0755)
+        write_file(bigparamfile, '\n'.join((base_params, param_text)))
 
-    with open(batchfile, 'w') as f:
-        f.write(batch_script(batchdir, batchname))
+        manifest['points'].append({'dir': batchname, 'params': params})
 
-    with open(bigparamfile, 'w') as f:
-        f.write('\n'.join((base_params, param_text)))
+    write_manifest(manifest, manifestfile)
+    print 'Wrote %d points, %d in the scan' % (opts.NUMBER, len(manifest['points']))
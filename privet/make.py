@@ -9,11 +9,14 @@ to boost my line count at github.
 devnull = open('/dev/null', 'w')
 
 import sys
-import hashlib
 import os
-from subprocess import Popen, PIPE
+import errno
+import random
+from subprocess import Popen
+from multiprocessing import cpu_count
 import time
 import logging
+from plugincache import build_plugins
 
 os.putenv('RIVET_ANALYSIS_PATH',os.getcwd())
 print os.getenv('RIVET_ANALYSIS_PATH')
@@ -32,22 +35,6 @@ except Exception, e:
     sys.stderr.write(str(e)+'\n')
     sys.exit(1)
 
-def md5sum(fileName, excludeLine='#'):
-    """Compute md5 hash of the specified file"""
-    m = hashlib.md5()
-    with open(filename, 'rb') as file:
-        for line in file:
-            if excludeLine and line.startswith(excludeLine) or line == '':
-                continue
-            m.update(line)
-        return m.hexdigest()
-
-def build_plugin(name, verbose=True):
-    so_name = 'Rivet%sAnalysis.so' % name
-    ana_name = '%s.cc' % name
-    process = Popen(['rivet-buildplugin', so_name, ana_name])
-    process.communicate()
-
 # Parsing command line options:
 from optparse import OptionParser
 parser = OptionParser(usage=__doc__, version='1')
@@ -73,53 +60,53 @@ parser.add_option('-t', '--options', dest='tempdir', default='/dev/shm',
         help='Directory to create pipes in. Defaults to /dev/shm')
 parser.add_option('-v', '--verbose', dest='verbose', action='store_true',
         default=True, help='make the program verbose')
+parser.add_option('--plugin-cache', dest='plugin_cache',
+        default=os.getenv('PRIVET_PLUGIN_CACHE', '~/.privet-plugins'),
+        help='Directory of the shared cache of built plugins. '
+        'Default: $PRIVET_PLUGIN_CACHE or ~/.privet-plugins')
+parser.add_option('--build-jobs', dest='build_jobs', type='int', default=cpu_count(),
+        help='Number of plugins to compile in parallel. Default: number of CPUs')
+parser.add_option('-S', '--supervise', dest='supervise', action='store_true',
+        default=False, help='Generate NUMBER events in total over the processes, '
+        'restarting failed ones with new seeds, and merge their histograms '
+        'at the end')
+parser.add_option('--max-restarts', dest='max_restarts', type='int', default=3,
+        help='Failures in a row after which a supervised process is given up. Default: 3')
+parser.add_option('--min-chunk', dest='min_chunk', type='int', default=100,
+        help='Smallest number of events to restart a supervised process with. Default: 100')
+parser.add_option('--merged', dest='merged', default=None,
+        help='File for the merged histograms of a supervised run. Default: privet-PREFIXall.aida')
 
 (opts,args) = parser.parse_args()
+logging.basicConfig(level=opts.verbose and logging.INFO or logging.WARNING,
+                    format='%(message)s')
+
+# The merging of a supervised run needs the lighthisto of this repository,
+# not the one that comes with rivet: the submitter stages a copy of it next
+# to this script, otherwise it is taken from the source tree
+if opts.supervise:
+    sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                    os.pardir, '2011-07-aida2yoda', 'pyext'))
+    try:
+        import lighthisto
+        if not hasattr(lighthisto, 'mergeAIDA') or lighthisto.numpy is None:
+            raise ImportError('%s has no mergeAIDA, or numpy is missing' % lighthisto.__file__)
+    except ImportError, e:
+        sys.stderr.write('Cannot merge the histograms of a supervised run: %s\n' % e)
+        sys.exit(1)
 
 # Now we check if the file should be built automatically
 analyses = args
 all_analyses = rivet.AnalysisLoader.analysisNames()
 
-# Build a dictionary of files -> md5
-try:
-    with open('.makerc', 'r') as file:
-        md5s = dict(line.split() for line in file)
-except IOError, e:
-    md5s = {}
-
-# Get analyses with cc on the end. We wish to preserve the order.
-for i, filename in enumerate(analyses):
-    if not filename.endswith('.cc'): 
-        continue
-
-    # Strip filename of its extension
-    name = filename[:-3]
-    analyses[i] = name
-
-    newsum = md5sum(filename)
-    oldsum = md5s.get(filename,'')
-
-    if oldsum == newsum:
-        continue
-    else:
-        build_plugin(name, verbose=opts.verbose)
-        md5s[filename] = newsum
-
-# Some moving around of the fles to be sure we have what we need in the file
-# Great! :)
-
-with open('.makerc.swp', 'w') as out:
-    lines = (' '.join(i) for i in md5s.iteritems())
-    out.write('\n'.join(lines))
+failed = build_plugins(analyses, opts.plugin_cache, opts.build_jobs, opts.verbose)
+if failed:
+    sys.stderr.write('Could not build the plugins for %s\n' % ', '.join(failed))
+    sys.exit(1)
 
 # Quick hack, only pick first analysis!
 analysis = analyses[0]
 
-# Changing this to os.rename, simple reason that...
-# "If successful, the renaming will be an atomic operation
-# (this is a POSIX requirement)"
-os.rename('.makerc.swp', '.makerc')
-
 
 # Make fifos
 pipes = []
@@ -130,10 +117,14 @@ def run_rivet(pipe, analysis, histfile):
     rivet_args = ['rivet','-a',analysis, '-H', histfile, pipe]
     return Popen(rivet_args)
 
-def run_agile(pipe, generator, beams, number, params, pfile):
+def run_agile(pipe, generator, beams, number, params, pfile, seed=None):
 
     agile_args = ['agile-runmc', generator, '--beams=%s' % beams, '-n', number,
-                  '-o', pipe, '--randomize-seed']
+                  '-o', pipe]
+    if seed is None:
+        agile_args.append('--randomize-seed')
+    else:
+        agile_args.append('--seed=%d' % seed)
     if params:
         agile_args.extend(('-p', params))
     if pfile:
@@ -142,18 +133,186 @@ def run_agile(pipe, generator, beams, number, params, pfile):
 
 pipe_fn = lambda n: '/dev/shm/privet-%s%02d.fifo' % (opts.prefix, n)
 aida_fn = lambda n: 'privet-%s%02d.aida' % (opts.prefix, n)
+# Restarted and later jobs of a supervised process get their own files
+job_fn = lambda n, serial: serial and 'privet-%s%02d-%02d.aida' % (opts.prefix, n, serial) or aida_fn(n)
+
+def exit_code(status):
+    """Popen style return code of an os.wait() exit status"""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+def kill(process):
+    try:
+        process.kill()
+    except OSError, e:
+        pass
+
+class Job(object):
+    """An agile-runmc | rivet pair generating a share of the events on one worker"""
+
+    def __init__(self, worker, serial, nevents, seed):
+        self.worker = worker
+        self.nevents = nevents
+        self.seed = seed
+        self.pipe = pipe_fn(worker)
+        self.histfile = job_fn(worker, serial)
+        self.agile = None
+        self.rivet = None
+
+    def start(self, analysis):
+        if os.path.exists(self.histfile):
+            os.remove(self.histfile)
+        self.agile = run_agile(self.pipe, opts.generator, opts.beams, str(self.nevents),
+                               opts.params, opts.pfile, self.seed)
+        self.rivet = run_rivet(self.pipe, analysis, self.histfile)
+
+    def processes(self):
+        return [self.agile, self.rivet]
+
+    def reaped(self, process, status):
+        """Record the exit of one of the pair and stop the other one if the pair is broken"""
+        process.returncode = exit_code(status)
+        if process is self.rivet and self.agile.returncode is None:
+            # Nobody is reading the pipe any more
+            kill(self.agile)
+        elif process is self.agile and process.returncode != 0 and self.rivet.returncode is None:
+            # rivet may still be waiting for the pipe to be opened
+            kill(self.rivet)
+
+    def finished(self):
+        return self.agile.returncode is not None and self.rivet.returncode is not None
+
+    def succeeded(self):
+        return (self.agile.returncode == 0 and self.rivet.returncode == 0
+                and os.path.exists(self.histfile))
+
+class Supervisor(object):
+    """Keeps agile-runmc | rivet pairs running until a total number of events is done.
+
+    The events are handed out in shares over the live workers. The events
+    of a failed job are handed out again, with new seeds, as the workers
+    become free, and a worker is given up after max_restarts failures
+    in a row. Instead of polling, the supervisor sleeps in os.wait()
+    until one of the processes exits."""
+
+    def __init__(self, analysis, total, nworkers, max_restarts=3, min_chunk=100):
+        self.analysis = analysis
+        self.total = total
+        self.max_restarts = max_restarts
+        self.min_chunk = max(min_chunk, 1)
+        self.idle = range(nworkers)
+        self.live = set(self.idle)
+        self.failures = dict((n, 0) for n in self.idle)
+        self.serials = dict((n, 0) for n in self.idle)
+        # pid -> (job, process)
+        self.running = {}
+        # (histfile, number of events) of the successful jobs
+        self.done = []
+        self.ndone = 0
+        self.random = random.SystemRandom()
+
+    def pending(self):
+        """Events that are neither done nor being generated"""
+        jobs = set(job for job, p in self.running.itervalues())
+        return self.total - self.ndone - sum(job.nevents for job in jobs)
+
+    def fill(self):
+        """Start jobs on the idle workers for a share each of the pending events"""
+        pending = self.pending()
+        if pending <= 0 or not self.idle:
+            return
+        share = max(-(-pending // len(self.live)), self.min_chunk)
+        while self.idle and pending > 0:
+            n = self.idle.pop(0)
+            nevents = min(share, pending)
+            job = Job(n, self.serials[n], nevents, self.random.randint(1, 2**31 - 1))
+            self.serials[n] += 1
+            job.start(self.analysis)
+            for process in job.processes():
+                self.running[process.pid] = (job, process)
+            pending -= nevents
+            logging.info('Worker %02d: started %d events with seed %d into %s'
+                         % (n, nevents, job.seed, job.histfile))
+
+    def finish(self, job):
+        n = job.worker
+        if job.succeeded():
+            self.ndone += job.nevents
+            self.done.append((job.histfile, job.nevents))
+            self.failures[n] = 0
+            logging.info('Worker %02d: finished %d events, %d of %d done'
+                         % (n, job.nevents, self.ndone, self.total))
+        else:
+            self.failures[n] += 1
+            logging.warning('Worker %02d: failed with agile-runmc exit code %s and rivet exit code %s, '
+                            'its %d events will be generated again'
+                            % (n, job.agile.returncode, job.rivet.returncode, job.nevents))
+            if os.path.exists(job.histfile):
+                os.remove(job.histfile)
+            if self.failures[n] > self.max_restarts:
+                logging.error('Worker %02d: giving up after %d failures in a row' % (n, self.failures[n]))
+                self.live.discard(n)
+                return
+        self.idle.append(n)
+
+    def run(self):
+        """Run until all the events are done or all the workers are given up.
+        Returns True if all the events were done."""
+        self.fill()
+        while self.running:
+            try:
+                pid, status = os.wait()
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if not self.running.has_key(pid):
+                continue
+            job, process = self.running.pop(pid)
+            job.reaped(process, status)
+            if job.finished():
+                self.finish(job)
+                self.fill()
+        return self.ndone >= self.total
+
+    def stop(self):
+        """Kill and reap all the running processes"""
+        for job, process in self.running.values():
+            kill(process)
+            process.wait()
+        self.running.clear()
 
 try:
     for n in xrange(opts.threads):
         pipe = pipe_fn(n)
-        histfile = aida_fn(n)
-
         try:
             pipes.append(pipe)
             os.mkfifo(pipe)
         except OSError, e:
             pass
 
+    if opts.supervise:
+        supervisor = Supervisor(analysis, int(opts.number), opts.threads,
+                                opts.max_restarts, opts.min_chunk)
+        try:
+            complete = supervisor.run()
+        finally:
+            supervisor.stop()
+        if not complete:
+            logging.error('Only %d of %d events were generated' % (supervisor.ndone, supervisor.total))
+        if supervisor.done:
+            merged = opts.merged or 'privet-%sall.aida' % opts.prefix
+            lighthisto.mergeAIDA(supervisor.done, merged)
+            logging.info('Merged %d files into %s' % (len(supervisor.done), merged))
+        if not complete:
+            sys.exit(1)
+        sys.exit(0)
+
+    for n in xrange(opts.threads):
+        pipe = pipe_fn(n)
+        histfile = aida_fn(n)
+
         agile = run_agile(pipe, opts.generator, opts.beams, opts.number, opts.params, opts.pfile)
         rivet = run_rivet(pipe, analysis, histfile)
 
@@ -164,7 +323,7 @@ try:
 
     while subprocesses:
         time.sleep(1)
-        for i, (n, a, r) in enumerate(subprocesses):
+        for i, (n, a, r) in reversed(list(enumerate(subprocesses))):
             aState, rState = a.poll(), r.poll()
             if rState is not None:
                 try:
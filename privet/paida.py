@@ -1,101 +1,183 @@
 #!/usr/bin/env python2
 
-## Adding two dat files:
+"""
+%prog [options] [file.dat ...]
+
+Adds up the histograms in flat .dat files, e.g. the blocks of the different
+runs that compare-histos puts into each .dat file. Histograms are matched by
+their path, with any '<file>.aida' prefix from compare-histos taken off, and
+the values are summed (or averaged) while the errors are added in quadrature.
+
+Without -o every file (by default all *.dat files here) is rewritten in place
+with its combined histograms. With -o the histograms of all the files are
+added up and written to the one output file.
+"""
+
+import os, re, tempfile
+import numpy as np
+
+## Histogram paths from compare-histos start with the run's AIDA file name
+aidaprefix = re.compile(r'.*\.aida(?=/)')
+
+
+def histoKey(beginline):
+    """The histogram path of a '# BEGIN HISTOGRAM' line, without the AIDA file prefix."""
+    path = beginline.strip()[len("# BEGIN HISTOGRAM"):].strip()
+    return aidaprefix.sub('', path, 1)
+
+
+def readBlocks(lines):
+    """Split the lines of a .dat file into histogram blocks.
+
+    Returns the lines outside the histogram blocks, and a list of (path,
+    header lines, bin array) tuples, one per block. The '##' comment lines in
+    histogram blocks (area, number of bins, ...) are dropped since they
+    won't hold for the sum."""
+    outside, blocks = [], []
+    header, rows, key = None, None, None
+    for line in lines:
+        stripped = line.strip()
+        if stripped.startswith("# BEGIN HISTOGRAM"):
+            key, header, rows = histoKey(stripped), [line], []
+        elif header is None:
+            outside.append(line)
+        elif stripped.startswith("# END HISTOGRAM"):
+            blocks.append((key, header, np.array(rows, dtype=float)))
+            header, rows, key = None, None, None
+        elif not stripped or stripped.startswith("##"):
+            continue
+        elif stripped.startswith("#") or "=" in stripped:
+            header.append(line)
+        else:
+            rows.append(stripped.split())
+    return outside, blocks
+
+
+class DatAccumulator(object):
+    """Running sums of histograms, keyed by histogram path.
+
+    Each bin array has the bin edges in its first two columns, the value in
+    the third and errors in any further ones. For each path only the first
+    header and edges, the sum of values and the sums of squared errors are
+    kept, so memory doesn't grow with the number of files added."""
+
+    def __init__(self):
+        self.outside = None
+        self.paths = []
+        self.headers = {}
+        self.edges = {}
+        self.sums = {}
+        self.sumerrs2 = {}
+        self.counts = {}
+
+    def add(self, lines, source=""):
+        outside, blocks = readBlocks(lines)
+        if self.outside is None:
+            self.outside = outside
+        ## Group the blocks by path, keeping the file order
+        bypath = {}
+        for key, header, bins in blocks:
+            if not bypath.has_key(key):
+                bypath[key] = []
+                if not self.headers.has_key(key):
+                    self.paths.append(key)
+                    self.headers[key] = header
+            bypath[key].append(bins)
+        ## One reduction over the stacked blocks of each path
+        for key, arrays in bypath.iteritems():
+            shapes = set([a.shape for a in arrays])
+            if self.edges.has_key(key):
+                shapes.add(self.edges[key].shape[:1] + arrays[0].shape[1:])
+            if len(shapes) != 1 or len(arrays[0].shape) != 2 or arrays[0].shape[1] < 3:
+                print "Skipping %s in %s: its bins don't match" % (key, source)
+                continue
+            stack = np.array(arrays)
+            values = stack[:, :, 2].sum(axis=0)
+            errs2 = (stack[:, :, 3:]**2).sum(axis=0)
+            if self.edges.has_key(key):
+                self.sums[key] += values
+                self.sumerrs2[key] += errs2
+                self.counts[key] += len(arrays)
+            else:
+                self.edges[key] = stack[0, :, :2]
+                self.sums[key] = values
+                self.sumerrs2[key] = errs2
+                self.counts[key] = len(arrays)
+
+    def format(self, average=False):
+        out = list(self.outside or [])
+        for key in self.paths:
+            if not self.edges.has_key(key):
+                continue
+            n = float(self.counts[key])
+            values = self.sums[key]
+            errs = np.sqrt(self.sumerrs2[key])
+            if average:
+                values = values / n
+                errs = errs / n
+            table = np.column_stack((self.edges[key], values, errs))
+            out.extend(self.headers[key])
+            out.append("## Combined from %d histograms\n" % self.counts[key])
+            rowformat = "\t".join(["%e"] * table.shape[1]) + "\n"
+            out.extend([rowformat % tuple(row) for row in table.tolist()])
+            out.append("# END HISTOGRAM\n")
+        return "".join(out)
+
+
+def writeAtomically(filename, text):
+    """Write text to a temporary file next to filename and rename it into place."""
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)),
+                                   prefix="." + os.path.basename(filename))
+    try:
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmpname, 0666 & ~umask)
+        out = os.fdopen(fd, "w")
+        out.write(text)
+        out.close()
+        os.rename(tmpname, filename)
+    except:
+        os.remove(tmpname)
+        raise
 
-from glob import glob
-files = glob("*.dat")
-
-def finder(content):
-    foundBegin = False
-    foundTitle = False
-    output = ['']*1000
-    counter = 0
-
-    for line in content:
-        if line.find("# BEGIN HISTOGRAM") != -1:
-            foundBegin = True
-        if foundBegin and foundTitle:
-            output[counter] += line 
-        if foundBegin and line.find("Title") != -1:
-            foundTitle = True
-
-        if line.find("# END HISTOGRAM") != -1:
-            foundBegin = False
-            foundTitle = False
-            counter += 1
-    
-    return output 
-
-def printOut(content, output):
-    dat = ""
-    foundTitle = False
-    for line in content:
-        if foundTitle and line.find("Title") != -1:
-            dat += line
-            break
-        if line.find("Title") != -1:
-            foundTitle = True
-        dat += line
-    
-    for line in output:
-        for number in line:
-            dat += str(number) + "   "
-        dat += "\n"
-    dat += "# END HISTOGRAM"
-    
-    return dat
 
 ## Parsing
 from optparse import OptionParser
-usage = "usage: %prog [options] arg1 arg2"
-parser = OptionParser(usage=usage, version="1")
+parser = OptionParser(usage=__doc__, version="1")
 parser.add_option("-a", "--average", dest="AVERAGE", action="store_true",
     default=False, help="if specified the data will be averaged between the file that are added. Default is False, but in most cases (all when any kind of normalistaion is on) it needs to be set.")
-(args, options) = parser.parse_args()
-average = args.AVERAGE
+parser.add_option("-o", "--output", dest="OUTPUT", default=None,
+    help="add up the histograms of all the files into this file, instead of combining each file in place")
+(opts, args) = parser.parse_args()
+
+from glob import glob
+from progressbar import Bar, ETA, Percentage, ProgressBar
+files = args or sorted(glob("*.dat"))
 
 ## The 'almost main' loop
+widgets = ['Adding histograms:', Percentage(), ' ', Bar(marker='0', left='[', right=']'), ' ', ETA(), ' ']
+pbar = ProgressBar(widgets=widgets, maxval=max(len(files), 1))
+accumulator = DatAccumulator()
 count = 0
-for dat in files:
+for i, dat in enumerate(files):
     histo = open(dat, "r")
     content = histo.readlines()
     histo.close()
-    
+
     ## Protection against empty files
     if len(content) == 0:
         continue
-        count +=1
-    begin = finder(content)
-
-    ## Now, numpy parsing:
-    import numpy as np
-    from StringIO import StringIO
-    from progressbar import Bar, ETA, Percentage, ProgressBar 
-    
-    array = [] 
-    for matrix in begin:
-        if len(matrix) > 0:
-            array.append(np.genfromtxt(StringIO(matrix)))
-
-    # Settign up a progress bar
-    widgets = ['Adding arrays:', Percentage(), ' ', Bar(marker='0', left='[', right=']'), ' ', ETA(), ' ']
-    pbar = ProgressBar(widgets = widgets, maxval=len(array))
-    
-    # Adding
-    output = np.copy(array[0])
-    for i, matrix in enumerate(array[1:]):
-        output[:,2:] += matrix[:,2:]
-        pbar.update(float(i)/float(len(array)) + 1)
-    pbar.finish()
-
-    if average:
-        output /= len(array)
-    
-    ## Now the last bits of writing and moving stuff around:
-    import os
-    os.remove(dat)
-    out = open(dat, "w")
-    out.write(printOut(content,output))
-    out.close()
-
-print "Processed " + str(len(files) - count)+ " files"
+    count += 1
+
+    if opts.OUTPUT is None:
+        accumulator = DatAccumulator()
+    accumulator.add(content, dat)
+    if opts.OUTPUT is None:
+        writeAtomically(dat, accumulator.format(opts.AVERAGE))
+    pbar.update(i + 1)
+pbar.finish()
+
+if opts.OUTPUT is not None:
+    writeAtomically(opts.OUTPUT, accumulator.format(opts.AVERAGE))
+
+print "Processed " + str(count) + " files"
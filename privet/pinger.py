@@ -1,10 +1,185 @@
 #!/usr/bin/env python2
 
-from commands import getstatusoutput
-outputFile = open("lxplus.hosts", 'w')
-for i in xrange(100,500):
-    (stat, output) = getstatusoutput("ping lxplus" + str(i) + ".cern.ch -c 1")
-    if output.find("unknown host") == -1:
-        outputFile.write("mkawalec@lxplus" + str(i) + ".cern.ch 5"+ "\n")
-        print i
-outputFile.close()
+"""
+%prog [options] [host ...]
+
+Finds the reachable hosts, lxplus100 to lxplus499 by default, and writes them
+to a hosts file for the submitters, best first. The hosts are pinged by a
+bounded set of parallel workers, which measure the round trip time. With
+--load the free cores of each host are asked for over ssh as well, and give
+its number of threads.
+
+Each line of the hosts file reads 'user@host threads slots', followed by the
+measurements as a comment.
+"""
+
+import os
+import re
+import time
+from subprocess import Popen, PIPE
+from multiprocessing.pool import ThreadPool
+
+devnull = open('/dev/null', 'w')
+
+rtt_pattern = re.compile(r'time[=<]([\d.]+) ?ms')
+
+class Probe(object):
+    """Measures hosts with ping, and their load with ssh"""
+
+    def __init__(self, user=None, timeout=2):
+        self.user = user
+        self.timeout = timeout
+
+    def ping(self, host):
+        """Round trip time in ms, or None if the host doesn't answer"""
+        process = Popen(['ping', '-c', '1', '-W', str(self.timeout), host], stdout=PIPE, stderr=devnull)
+        output = process.communicate()[0]
+        match = rtt_pattern.search(output)
+        if process.returncode != 0 or not match:
+            return None
+        return float(match.group(1))
+
+    def load(self, host):
+        """(cores, load average) of host, or None if it can't be asked"""
+        target = self.user and '%s@%s' % (self.user, host) or host
+        process = Popen(['ssh', '-o', 'BatchMode=yes', '-o', 'ConnectTimeout=%d' % self.timeout,
+                         target, 'nproc && cat /proc/loadavg'], stdout=PIPE, stderr=devnull)
+        output = process.communicate()[0].split()
+        if process.returncode != 0 or len(output) < 2:
+            return None
+        return int(output[0]), float(output[1])
+
+class FakeProbe(object):
+    """Stand-in for Probe reading the hosts from a file, to try out pinger
+    without network access. Each line reads 'host rtt [cores load]', with
+    rtt in ms or '-' for a host that doesn't answer. Probing a host takes
+    its rtt."""
+
+    def __init__(self, filename):
+        self.hosts = {}
+        self.order = []
+        for line in open(filename):
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            self.order.append(fields[0])
+            self.hosts[fields[0]] = fields[1:]
+
+    def ping(self, host):
+        fields = self.hosts.get(host, ['-'])
+        if fields[0] == '-':
+            return None
+        time.sleep(float(fields[0]) / 1000)
+        return float(fields[0])
+
+    def load(self, host):
+        fields = self.hosts.get(host, [])
+        if len(fields) < 3:
+            return None
+        return int(fields[1]), float(fields[2])
+
+class Measurement(object):
+    def __init__(self, host, rtt, cores=None, load=None):
+        self.host = host
+        self.rtt = rtt
+        self.cores = cores
+        self.load = load
+
+    def free(self):
+        """Idle cores, None if unknown"""
+        if self.cores is None:
+            return None
+        return max(self.cores - self.load, 0)
+
+    def rank(self):
+        """Sort key: most free cores first, then the shortest round trip"""
+        free = self.free()
+        return (free is None and 1 or 0, -(free or 0), self.rtt)
+
+def measure(probe, host, withload):
+    rtt = probe.ping(host)
+    if rtt is None:
+        return None
+    measurement = Measurement(host, rtt)
+    if withload:
+        load = probe.load(host)
+        if load is not None:
+            measurement.cores, measurement.load = load
+    return measurement
+
+def probe_hosts(probe, hosts, workers=32, withload=False, progress=None):
+    """Measurements of the reachable hosts, best first. At most workers
+    hosts are probed at a time, and progress(done) is called as they finish."""
+    pool = ThreadPool(max(1, min(workers, len(hosts))))
+    try:
+        found = []
+        for n, measurement in enumerate(pool.imap_unordered(lambda host: measure(probe, host, withload), hosts)):
+            if measurement is not None:
+                found.append(measurement)
+            if progress:
+                progress(n + 1)
+    finally:
+        pool.close()
+        pool.join()
+    found.sort(key=Measurement.rank)
+    return found
+
+def hosts_line(measurement, user, threads, slots):
+    free = measurement.free()
+    if free is not None:
+        threads = max(int(free), 1)
+    line = '%s %d %d' % (user and '%s@%s' % (user, measurement.host) or measurement.host, threads, slots)
+    comment = '# %.1f ms' % measurement.rtt
+    if free is not None:
+        comment += ', %d cores, load %.2f' % (measurement.cores, measurement.load)
+    return line + '  ' + comment + '\n'
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser(usage=__doc__, version='1')
+    parser.add_option('-o', '--output', dest='OUTPUT', default='lxplus.hosts',
+            help='Hosts file to write. Default: lxplus.hosts')
+    parser.add_option('-u', '--user', dest='USER', default='mkawalec',
+            help='User name for the hosts. Default: mkawalec')
+    parser.add_option('--range', dest='RANGE', default='lxplus%d.cern.ch:100:500',
+            help='Hosts to look for when none are given, as pattern:first:end. '
+            'Default: lxplus%d.cern.ch:100:500')
+    parser.add_option('-w', '--workers', dest='WORKERS', type='int', default=32,
+            help='Hosts probed at the same time. Default: 32')
+    parser.add_option('-t', '--threads', dest='THREADS', type='int', default=5,
+            help='Threads for hosts with unknown load. Default: 5')
+    parser.add_option('-s', '--slots', dest='SLOTS', type='int', default=1,
+            help='Job slots of every host. Default: 1')
+    parser.add_option('--timeout', dest='TIMEOUT', type='int', default=2,
+            help='Seconds to wait for a host. Default: 2')
+    parser.add_option('-l', '--load', dest='LOAD', action='store_true', default=False,
+            help='Ask the hosts for their free cores over ssh')
+    parser.add_option('--fake', dest='FAKE', default=None,
+            help="Probe the hosts listed in FAKE, with lines 'host rtt [cores load]', instead of the network")
+    (opts, args) = parser.parse_args()
+
+    if opts.FAKE:
+        probe = FakeProbe(opts.FAKE)
+    else:
+        probe = Probe(opts.USER, opts.TIMEOUT)
+
+    hosts = args
+    if not hosts and opts.FAKE:
+        hosts = probe.order
+    elif not hosts:
+        pattern, first, end = opts.RANGE.rsplit(':', 2)
+        hosts = [pattern % i for i in xrange(int(first), int(end))]
+
+    from progressbar import Bar, ETA, Percentage, ProgressBar
+    widgets = ['Probing hosts:', Percentage(), ' ', Bar(marker='#', left='[', right=']'), ' ', ETA(), ' ']
+    pbar = ProgressBar(widgets=widgets, maxval=max(len(hosts), 1))
+    found = probe_hosts(probe, hosts, opts.WORKERS, opts.LOAD, pbar.update)
+    pbar.finish()
+
+    tmpname = opts.OUTPUT + '.swp'
+    outputFile = open(tmpname, 'w')
+    for measurement in found:
+        outputFile.write(hosts_line(measurement, opts.USER, opts.THREADS, opts.SLOTS))
+    outputFile.close()
+    os.rename(tmpname, opts.OUTPUT)
+    print '%d of %d hosts answered, written to %s' % (len(found), len(hosts), opts.OUTPUT)
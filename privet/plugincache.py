@@ -0,0 +1,196 @@
+"""
+Cache of the built Rivet*Analysis.so plugins, shared by make.py and
+bin/make-rivet.
+
+A plugin is keyed on the contents of its source and of the headers it
+includes and on the build environment (see build_environment), and kept in
+<cachedir>/<key>/. build_plugins installs the plugins of a list of analyses
+into the current directory, compiling the missing ones in parallel.
+"""
+
+import os
+import sys
+import shutil
+import hashlib
+import tempfile
+from subprocess import Popen, PIPE, STDOUT
+from multiprocessing.pool import ThreadPool
+
+devnull = open('/dev/null', 'w')
+
+# Environment variables that change what rivet-buildplugin produces
+BUILD_ENV = ('CXX', 'CXXFLAGS', 'CPPFLAGS', 'LDFLAGS')
+
+def which(program):
+    """Full path of an executable in the PATH, or None"""
+    for d in os.getenv('PATH', '').split(os.pathsep):
+        path = os.path.join(d, program)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+def command_output(args):
+    """Standard output of a command, empty if it can't be run"""
+    try:
+        return Popen(args, stdout=PIPE, stderr=devnull).communicate()[0]
+    except OSError, e:
+        return ''
+
+def file_hash(fileName, m=None):
+    """Update the hash m (a new sha1 by default) with the contents of a file"""
+    if m is None:
+        m = hashlib.sha1()
+    with open(fileName, 'rb') as file:
+        for block in iter(lambda: file.read(65536), ''):
+            m.update(block)
+    return m
+
+def build_environment():
+    """Hash of everything apart from the sources that goes into a plugin:
+    the rivet-buildplugin script, the rivet version and flags, the compiler
+    and the build environment variables"""
+    m = hashlib.sha1()
+    buildplugin = which('rivet-buildplugin')
+    if buildplugin:
+        file_hash(buildplugin, m)
+    m.update(command_output(['rivet-config', '--version']))
+    m.update(command_output(['rivet-config', '--cppflags', '--ldflags', '--libs']))
+    m.update(command_output([os.getenv('CXX', 'g++'), '--version']))
+    m.update(os.uname()[4])
+    for var in BUILD_ENV:
+        m.update('%s=%s\0' % (var, os.getenv(var, '')))
+    return m.hexdigest()
+
+def source_dependencies(source):
+    """The source file followed by all the headers it includes, as
+    listed by the compiler"""
+    cppflags = command_output(['rivet-config', '--cppflags']).split()
+    out = command_output([os.getenv('CXX', 'g++'), '-M'] + cppflags + [source])
+    # Make rule: 'target.o: source header1 header2 \<newline> header3 ...'
+    deps = out.replace('\\\n', ' ').split()[1:]
+    return [source] + [dep for dep in deps if dep != source]
+
+def plugin_key(source, environment):
+    """Cache key of a plugin, from the contents of its source and
+    included headers and the build environment hash"""
+    m = hashlib.sha1(environment)
+    for dep in source_dependencies(source):
+        m.update(os.path.basename(dep) + '\0')
+        try:
+            file_hash(dep, m)
+        except IOError, e:
+            m.update('missing\0')
+    return m.hexdigest()
+
+def install(src, dst):
+    """Hard link src to dst, copying it if that is not possible"""
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError, e:
+        shutil.copy2(src, dst)
+
+class PluginCache(object):
+    """Built Rivet*Analysis.so plugins, kept in <cachedir>/<key>/ so that
+    identical analyses are only compiled once for all the directories
+    (and hosts, if the cache is on a shared filesystem) using them"""
+
+    def __init__(self, cachedir):
+        self.cachedir = os.path.abspath(os.path.expanduser(cachedir))
+        if not os.path.isdir(self.cachedir):
+            os.makedirs(self.cachedir)
+
+    def path(self, key, so_name):
+        return os.path.join(self.cachedir, key, so_name)
+
+    def fetch(self, key, so_name):
+        """Install a cached plugin into the current directory, if there is one"""
+        path = self.path(key, so_name)
+        if not os.path.exists(path):
+            return False
+        install(path, so_name)
+        return True
+
+    def build(self, source, so_name, key):
+        """Compile a plugin into the cache, returns True if it worked.
+        The plugin is built in a temporary directory which is then renamed
+        to its key, so other builds never see a half written plugin."""
+        tmpdir = tempfile.mkdtemp(dir=self.cachedir, prefix='.tmp')
+        try:
+            process = Popen(['rivet-buildplugin', os.path.join(tmpdir, so_name),
+                             os.path.abspath(source)], stdout=PIPE, stderr=STDOUT)
+            output = process.communicate()[0]
+            if process.returncode != 0 or not os.path.exists(os.path.join(tmpdir, so_name)):
+                sys.stderr.write('Building %s failed:\n%s' % (so_name, output))
+                return False
+            try:
+                os.rename(tmpdir, os.path.dirname(self.path(key, so_name)))
+            except OSError, e:
+                # Someone else has built the same plugin meanwhile
+                if not os.path.exists(self.path(key, so_name)):
+                    raise
+            return True
+        finally:
+            if os.path.isdir(tmpdir):
+                shutil.rmtree(tmpdir, ignore_errors=True)
+
+def build_plugins(analyses, cachedir, jobs=1, verbose=True):
+    """Make sure the plugins for the '.cc' files among analyses are
+    up to date, replacing those by the analysis names.
+
+    Plugins are taken from the cache when possible and the missing ones
+    are compiled in parallel. '.makerc' keeps the cache key of each
+    plugin installed here, so unchanged plugins are left alone."""
+    try:
+        with open('.makerc', 'r') as file:
+            keys = dict(line.split() for line in file if line.strip())
+    except IOError, e:
+        keys = {}
+
+    try:
+        cache = PluginCache(cachedir)
+    except OSError, e:
+        sys.stderr.write('Cannot use the plugin cache in %s (%s), using .plugins\n' % (cachedir, e))
+        cache = PluginCache('.plugins')
+
+    environment = build_environment()
+    missing = []
+    # Get analyses with cc on the end. We wish to preserve the order.
+    for i, filename in enumerate(analyses):
+        if not filename.endswith('.cc'):
+            continue
+
+        # Strip filename of its extension
+        name = filename[:-3]
+        analyses[i] = name
+        so_name = 'Rivet%sAnalysis.so' % name
+
+        key = plugin_key(filename, environment)
+        if keys.get(filename) == key and os.path.exists(so_name):
+            continue
+        if cache.fetch(key, so_name):
+            if verbose:
+                print 'Using cached %s' % so_name
+            keys[filename] = key
+        else:
+            missing.append((filename, so_name, key))
+
+    if missing:
+        if verbose:
+            print 'Building %s' % ', '.join(so_name for f, so_name, k in missing)
+        pool = ThreadPool(max(1, min(jobs, len(missing))))
+        built = pool.map(lambda (f, so_name, key): cache.build(f, so_name, key), missing)
+        pool.close()
+        for (filename, so_name, key), ok in zip(missing, built):
+            if ok and cache.fetch(key, so_name):
+                keys[filename] = key
+
+    # Changing this to os.rename, simple reason that...
+    # "If successful, the renaming will be an atomic operation
+    # (this is a POSIX requirement)"
+    with open('.makerc.swp', 'w') as out:
+        lines = (' '.join(i) for i in keys.iteritems())
+        out.write('\n'.join(lines))
+    os.rename('.makerc.swp', '.makerc')
+    return [f for f, so_name, key in missing if keys.get(f) != key]
@@ -4,61 +4,88 @@
 The batch job submitter for professor and lxplus
 """
 
-devnull = open('/dev/null', 'w')
+def LaunchJobs(hosts, stager, eventlog, pending=False):
+    from progress import Tracker
+    from scanindex import ScanIndex
 
-def LaunchJobs(hosts):
-    from multiprocessing import Process
-    from subprocess import call
-    from progressbar import Bar, ETA, Percentage, ProgressBar
-    from time import sleep
-    from os import listdir
+    #Now, take the run directories from the index of the scan, which is
+    #brought up to date first:
+    index = ScanIndex('mc')
+    index.update()
+    if pending:
+        runs = index.query(['new', 'failed', 'running'])
+    else:
+        runs = index.query()
+    dirs = ['mc/' + run['name'] for run in runs]
+    tracker = Tracker(len(dirs), eventlog)
 
-    #Now, take the directories in which we have the script:
-    dirs = listdir("mc/*")
-    subprocess = []
-
-    servers = open(hosts[0], 'r').readlines()
+    servers = [line.split() for line in open(hosts[0], 'r') if line.strip()]
     for n, directory in enumerate(dirs):
-        line = servers[n%len(servers)]
-        line.strip()
-        index = line.find(" ")
-        subprocess.append(Process(target=LaunchSsh, args=(line[:index], directory)))
+        host = servers[n%len(servers)][0]
+        tracker.spawn(LaunchSsh, stager, tracker, index, host, directory)
+
+    # The progress bar follows the events of the jobs
+    tracker.follow()
+    tracker.summary()
 
-    for process in subprocess:
-        process.start()
-    
-    counter = 0
-    widgets = ['Computing on the grid:', Percentage(), ' ', Bar(marker='#', left='[', right=']'), ' ', ETA(), ' ']
-    pbar = ProgressBar(widgets = widgets, maxval=len(subprocess))
-    while counter < len(subprocess):
-        counter = 0
-        sleep(0.5)
-        for process in subprocess:
-            if not process.is_alive():
-                counter += 1
-        pbar.update(counter)
-    pbar.finish()
+def LaunchSsh(stager, tracker, index, host, directory):
+    from glob import glob
+    from time import time
+    import traceback
 
-def LaunchSsh(host, directory):
-    from subprocess import call
+    name = directory.split('/')[-1]
+    tracker.started(directory, host)
+    index.started(name)
+    start = time()
+    error = None
 
-    #Setting up and running the program:
-    call("ssh " + host + " \' mkdir -p ~/pprofessor/" + directory + " \'", stdout = devnull, stderr = devnull, shell=True)
-    call(['scp mc/' + directory + "* " + host + ':~/pprofessor/' + directory], shell=True, stdout = devnull, stderr = devnull)
-    call(["ssh " + host + " \' cd ~/pprofessor" + directory + " && batch.sh \'"], shell=True,stdout = devnull, stderr = devnull)
+    try:
+        #Setting up and running the program, all over the one connection to the host.
+        #Files the host has seen before are taken from its store instead of copied:
+        remotedir = 'pprofessor/' + directory
+        code = (stager.stage(host, glob(directory + '/*'), remotedir)
+                or stager.transport.run(host, 'cd ' + remotedir + ' && batch.sh'))
 
-    #And copying it all up:
-    call(["scp " + host + ":~/pprofessor" + directory + "* mc/" + directory], shell=True, stdout=devnull, stderr=devnull)
+        #And copying up what has changed:
+        code = stager.fetch(host, remotedir, '*', directory) or code
+    except Exception, e:
+        code = -1
+        error = traceback.format_exc()
+        sys.stderr.write('\nRun %s on %s raised an exception:\n%s' % (directory, host, error))
+    index.finished(name, code, time() - start)
+    tracker.finished(directory, host, code, time() - start, stager.transferred(), error=error)
 
 
 
 import sys
-if sys.version_info[:3] < (2, 4, 0):
-    print 'We need at least python 2.4.'
-    system.exit(1)
+if sys.version_info[:3] < (2, 6, 0):
+    print 'We need at least python 2.6.'
+    sys.exit(1)
+
+from optparse import OptionParser
+parser = OptionParser(usage=__doc__, version='1')
+parser.add_option('--local', dest='LOCAL', default=None,
+        help='Run the jobs in LOCAL/<host> directories instead of over ssh')
+parser.add_option('-z', '--compress', dest='COMPRESS', action='store_true', default=False,
+        help='Compress the files copied over ssh')
+parser.add_option('--event-log', dest='EVENTLOG', default='pprofessor-events.jsonl',
+        help='File to append the job events to, as JSON lines. Default: pprofessor-events.jsonl')
+parser.add_option('-p', '--pending', dest='PENDING', action='store_true', default=False,
+        help="Only run the runs the scan index doesn't have as done")
+(opts, args) = parser.parse_args()
+
+from transport import SshTransport, LocalTransport
+from staging import Stager
+if opts.LOCAL:
+    transport = LocalTransport(opts.LOCAL)
+else:
+    transport = SshTransport(compress=opts.COMPRESS)
 
 #Now, take the hosts from the file:
 hosts = []
 from glob import glob
 hosts = glob("*.hosts")
-LaunchJobs(hosts)
+try:
+    LaunchJobs(hosts, Stager(transport), opts.EVENTLOG, opts.PENDING)
+finally:
+    transport.close()
@@ -0,0 +1,163 @@
+"""
+Progress of batch jobs, followed through the events the worker threads report.
+
+The workers put 'start' and 'finish' events (with the exit code, duration
+and bytes transferred of the job) on a queue. The main thread sleeps on the
+queue and updates the progress bar and the per-host statistics as the events
+come in, and writes every event as a line of JSON to the event log.
+"""
+
+import sys
+import json
+import time
+import Queue
+import threading
+from progressbar import Bar, ETA, Percentage, ProgressBar, ProgressBarWidget
+
+class HostStats(object):
+    def __init__(self):
+        self.done = 0
+        self.failed = 0
+        self.seconds = 0.0
+        self.bytes = 0
+
+def format_bytes(n):
+    for unit in ['B', 'kB', 'MB', 'GB']:
+        if n < 1000:
+            break
+        n /= 1000.
+    return '%.1f %s' % (n, unit)
+
+class JobRate(ProgressBarWidget):
+    "Widget for the running jobs and the rate at which they finish"
+    def __init__(self, tracker):
+        self.tracker = tracker
+    def update(self, pbar):
+        return '%d running, %.1f jobs/min' % (len(self.tracker.running), 60 * self.tracker.rate())
+
+class JobETA(ETA):
+    "Widget for the ETA from the durations of the jobs done so far"
+    def __init__(self, tracker):
+        self.tracker = tracker
+    def update(self, pbar):
+        if pbar.finished:
+            return 'Time: %s' % self.format_time(pbar.seconds_elapsed)
+        eta = self.tracker.eta()
+        if eta is None:
+            return 'ETA:  --:--:--'
+        return 'ETA:  %s' % self.format_time(eta)
+
+class Tracker(object):
+    """Progress of total jobs, done of which were done before we started.
+
+    Worker threads are started with spawn() and report with started() and
+    finished(); follow() handles the events until all the workers are over."""
+
+    def __init__(self, total, logfile=None, title='Computing on the grid:', done=0):
+        self.total = total
+        self.title = title
+        self.over = done
+        self.before = done
+        self.events = Queue.Queue()
+        self.workers = 0
+        # (job, host) -> start time, of the running jobs
+        self.running = {}
+        self.durations = []
+        self.hosts = {}
+        self.begin = time.time()
+        self.log = None
+        if logfile:
+            self.log = open(logfile, 'a')
+
+    def emit(self, kind, job, host, **fields):
+        event = dict(fields, event=kind, job=job, host=host, time=time.time())
+        self.events.put(event)
+
+    def started(self, job, host):
+        self.emit('start', job, host)
+
+    def finished(self, job, host, exit, duration, nbytes=0, final=True, error=None):
+        """A job has finished with exit code exit; it is over unless it is
+        going to be tried again (final False). error is the traceback of the
+        exception that ended the job, if any"""
+        self.emit('finish', job, host, exit=exit, duration=duration, bytes=nbytes, final=final,
+                  error=error)
+
+    def spawn(self, target, *args):
+        """Start a worker thread running target(*args)"""
+        def worker():
+            try:
+                target(*args)
+            finally:
+                self.events.put(None)
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        self.workers += 1
+        thread.start()
+        return thread
+
+    def rate(self):
+        """Jobs over per second since we started"""
+        elapsed = time.time() - self.begin
+        if elapsed <= 0:
+            return 0.0
+        return (self.over - self.before) / elapsed
+
+    def eta(self):
+        """Seconds left, from the mean job duration and the jobs running in parallel"""
+        if not self.durations:
+            return None
+        mean = sum(self.durations) / len(self.durations)
+        return (self.total - self.over) * mean / max(len(self.running), 1)
+
+    def handle(self, event):
+        host = self.hosts.setdefault(event['host'], HostStats())
+        key = (event['job'], event['host'])
+        if event['event'] == 'start':
+            self.running[key] = event['time']
+        elif event['event'] == 'finish':
+            self.running.pop(key, None)
+            self.durations.append(event['duration'])
+            host.seconds += event['duration']
+            host.bytes += event['bytes']
+            if event['exit'] == 0:
+                host.done += 1
+            else:
+                host.failed += 1
+            if event['final']:
+                self.over += 1
+        if self.log:
+            self.log.write(json.dumps(event) + '\n')
+            self.log.flush()
+
+    def follow(self):
+        """Handle the events until all the workers are over, updating the progress bar"""
+        widgets = [self.title, Percentage(), ' ', Bar(marker='#', left='[', right=']'), ' ',
+                   JobRate(self), ' ', JobETA(self), ' ']
+        pbar = ProgressBar(widgets=widgets, maxval=max(self.total, 1))
+        pbar.start()
+        while self.workers:
+            try:
+                # The timeout only keeps the wait interruptible by Ctrl-C
+                event = self.events.get(True, 3600)
+            except Queue.Empty:
+                continue
+            if event is None:
+                self.workers -= 1
+                continue
+            self.handle(event)
+            # Redraw for every event, not only when the percentage changes
+            pbar.prev_percentage = -1
+            pbar.update(min(self.over, pbar.maxval))
+        pbar.finish()
+        if self.log:
+            self.log.close()
+
+    def summary(self, out=sys.stdout):
+        """Print the statistics of every host"""
+        for name in sorted(self.hosts):
+            host = self.hosts[name]
+            njobs = host.done + host.failed
+            out.write('%s: %d done, %d failed, %.1f s per job, %s transferred\n'
+                      % (name, host.done, host.failed, njobs and host.seconds / njobs or 0,
+                         format_bytes(host.bytes)))
@@ -0,0 +1,226 @@
+#!/usr/bin/env python2
+
+"""
+%prog [options] SCANDIR
+
+Index of the runs of a Professor scan directory (as made by mkbatch.py), one
+NNN/ directory per run. The index, SCANDIR/index.json, records for every run
+its parameter point, status, number of events, output file with its size and
+sha1, and the timing of its last job, so that the runs can be looked up
+without opening the files of every run directory.
+
+Updating the index only reads the files of the runs whose output has changed
+since the last update. The submitters update it as the jobs finish.
+"""
+
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+
+INDEX_NAME = 'index.json'
+OUTPUT_NAME = 'out.aida'
+
+run_pattern = re.compile(r'^\d+$')
+events_pattern = re.compile(r'\s-n\s+(\d+)')
+
+def read_params(filename):
+    """{name: value} from a used_params file"""
+    params = {}
+    with open(filename, 'r') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 2 and not fields[0].startswith('#'):
+                params[fields[0]] = float(fields[1])
+    return params
+
+def read_events(filename):
+    """Number of events the batch.sh of a run asks for, None if unknown"""
+    try:
+        with open(filename, 'r') as f:
+            match = events_pattern.search(f.read())
+    except IOError, e:
+        return None
+    return match and int(match.group(1)) or None
+
+def file_sha1(filename):
+    m = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(65536), ''):
+            m.update(block)
+    return m.hexdigest()
+
+class ScanIndex(object):
+    """The runs of the scan in scandir, kept in scandir/index.json.
+
+    Every run is a dict with the keys name, params, status ('new', 'running',
+    'done' or 'failed'), events, output, size, mtime, sha1, started, finished,
+    duration and exit. The methods can be called from several threads."""
+
+    def __init__(self, scandir):
+        self.scandir = scandir
+        self.path = os.path.join(scandir, INDEX_NAME)
+        self.lock = threading.Lock()
+        self.runs = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                self.runs = json.load(f)['runs']
+
+    def save(self):
+        # The threads share the swap file, so the write and the rename are
+        # done under the lock as well
+        with self.lock:
+            data = json.dumps({'scandir': os.path.abspath(self.scandir), 'runs': self.runs},
+                              indent=1, sort_keys=True)
+            tmpname = '%s.%d.swp' % (self.path, os.getpid())
+            with open(tmpname, 'w') as f:
+                f.write(data)
+            os.rename(tmpname, self.path)
+
+    def manifest_params(self):
+        """{run name: params} from the manifest of mkbatch.py, if there is one"""
+        manifest = os.path.join(self.scandir, 'manifest.json')
+        if not os.path.exists(manifest):
+            return {}
+        with open(manifest, 'r') as f:
+            return dict((point['dir'], point['params']) for point in json.load(f)['points'])
+
+    def refresh(self, name, params=None):
+        """Bring the record of run name up to date with its directory, reading
+        only what has changed. Returns the record."""
+        rundir = os.path.join(self.scandir, name)
+        with self.lock:
+            run = dict(self.runs.get(name) or
+                       {'name': name, 'params': None, 'status': 'new', 'events': None,
+                        'output': None, 'size': None, 'mtime': None, 'sha1': None,
+                        'started': None, 'finished': None, 'duration': None, 'exit': None})
+        if params is not None:
+            run['params'] = params
+        elif run['params'] is None and os.path.exists(os.path.join(rundir, 'used_params')):
+            run['params'] = read_params(os.path.join(rundir, 'used_params'))
+        if run['events'] is None:
+            run['events'] = read_events(os.path.join(rundir, 'batch.sh'))
+
+        output = os.path.join(rundir, OUTPUT_NAME)
+        try:
+            st = os.stat(output)
+        except OSError, e:
+            st = None
+        if st is None or st.st_size == 0:
+            run.update(output=None, size=None, mtime=None, sha1=None)
+            if run['status'] == 'done':
+                run['status'] = 'new'
+        elif (st.st_mtime, st.st_size) != (run['mtime'], run['size']):
+            run.update(output=os.path.join(name, OUTPUT_NAME), size=st.st_size,
+                       mtime=st.st_mtime, sha1=file_sha1(output))
+            # Output newer than a failed job comes from a later run of it
+            if run['status'] == 'new' or (run['status'] == 'failed' and
+                                          st.st_mtime > (run['finished'] or 0)):
+                run['status'] = 'done'
+        with self.lock:
+            self.runs[name] = run
+        return run
+
+    def update(self):
+        """Add the new run directories of the scan and refresh the known ones"""
+        params = self.manifest_params()
+        names = [name for name in os.listdir(self.scandir)
+                 if run_pattern.match(name) and os.path.isdir(os.path.join(self.scandir, name))]
+        for name in names:
+            self.refresh(name, params.get(name))
+        with self.lock:
+            for name in set(self.runs) - set(names):
+                del self.runs[name]
+        self.save()
+
+    def started(self, name):
+        with self.lock:
+            run = self.runs[name]
+            run.update(status='running', started=time.time(), finished=None,
+                       duration=None, exit=None)
+        self.save()
+
+    def finished(self, name, exit, duration=None):
+        """Record the end of the job of run name, with exit code exit"""
+        with self.lock:
+            run = self.runs[name]
+            run.update(status=exit == 0 and 'done' or 'failed', finished=time.time(), exit=exit)
+            if duration is None and run['started'] is not None:
+                duration = run['finished'] - run['started']
+            run['duration'] = duration
+        run = self.refresh(name)
+        if run['output'] is None and run['status'] == 'done':
+            # A job that made no output hasn't done its run
+            with self.lock:
+                run['status'] = 'failed'
+        self.save()
+
+    def query(self, status=None, ranges=None, where=None):
+        """The runs, in name order, with the given status (a status or a list
+        of them), params in ranges ({param: (low, high)}) and for which
+        where(run) is true"""
+        if isinstance(status, basestring):
+            status = [status]
+        with self.lock:
+            runs = [self.runs[name] for name in sorted(self.runs)]
+        selected = []
+        for run in runs:
+            if status is not None and run['status'] not in status:
+                continue
+            if ranges:
+                params = run['params'] or {}
+                if not all(params.has_key(p) and low <= params[p] <= high
+                           for p, (low, high) in ranges.iteritems()):
+                    continue
+            if where is not None and not where(run):
+                continue
+            selected.append(run)
+        return selected
+
+    def path_of(self, run):
+        """Local path of the output of run, None if it has none"""
+        return run['output'] and os.path.join(self.scandir, run['output'])
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    parser = OptionParser(usage=__doc__)
+    parser.add_option('-s', '--status', dest='STATUS', default=None,
+            help='Only list the runs with this status, or comma separated statuses')
+    parser.add_option('-r', '--range', dest='RANGES', action='append', default=[],
+            help="Only list the runs with the parameter in a range, as 'NAME:LOW:HIGH'. "
+            "Can be given several times")
+    parser.add_option('--runcombs', dest='RUNCOMBS', default=None,
+            help="Write the names of the listed runs, on one line, to RUNCOMBS for prof-interpolate")
+    parser.add_option('-q', '--quiet', dest='QUIET', action='store_true', default=False,
+            help="Don't list the runs")
+    (opts, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error('give the scan directory')
+
+    index = ScanIndex(args[0])
+    index.update()
+
+    ranges = {}
+    for r in opts.RANGES:
+        try:
+            name, low, high = r.rsplit(':', 2)
+            ranges[name] = (float(low), float(high))
+        except ValueError, e:
+            parser.error("bad range '%s', expected 'NAME:LOW:HIGH'" % r)
+    runs = index.query(opts.STATUS and opts.STATUS.split(','), ranges)
+
+    if not opts.QUIET:
+        for run in runs:
+            params = ' '.join('%s=%g' % item for item in sorted((run['params'] or {}).iteritems()))
+            print '%s %-7s %s' % (run['name'], run['status'], params)
+    if opts.RUNCOMBS:
+        with open(opts.RUNCOMBS, 'w') as f:
+            f.write(' '.join(run['name'] for run in runs) + '\n')
+
+    counts = {}
+    for run in index.query():
+        counts[run['status']] = counts.get(run['status'], 0) + 1
+    print '%d runs: %s' % (len(index.runs),
+                           ', '.join('%d %s' % (n, status) for status, n in sorted(counts.iteritems())))
@@ -0,0 +1,146 @@
+"""
+Staging of the job inputs and outputs over a transport (see transport.py).
+
+Every host has a content addressed store, ~/.privet-store, holding one file
+per sha1 of the inputs ever sent to it. Staging files into a job directory
+uploads only the contents the host doesn't have yet and places them from the
+store, so inputs shared by the jobs (sources, parameter files, ...) cross
+the network once per host. Fetching results compares the sha1s on both
+sides and copies only the files that are new or have changed.
+
+The inputs are hard linked from the store where the filesystem allows it,
+and copied from it where it doesn't, e.g. on AFS, which has no hard links
+between directories. Since the staged inputs may be links into the store,
+jobs should replace their input files rather than write to them in place.
+"""
+
+import os
+import shutil
+import hashlib
+import tempfile
+import threading
+from pipes import quote
+
+class Stager(object):
+    """Content addressed staging of files to and from the hosts of a transport"""
+
+    def __init__(self, transport, store='.privet-store'):
+        self.transport = transport
+        self.store = store
+        # local path -> (mtime, size, sha1)
+        self.hashes = {}
+        # host -> sha1s known to be in its store
+        self.stored = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+        # Bytes copied by each thread, see transferred()
+        self.counts = threading.local()
+
+    def count(self, nbytes):
+        self.counts.bytes = getattr(self.counts, 'bytes', 0) + nbytes
+
+    def transferred(self):
+        """Bytes copied by the calling thread since its last call"""
+        nbytes = getattr(self.counts, 'bytes', 0)
+        self.counts.bytes = 0
+        return nbytes
+
+    def sha1(self, path):
+        """sha1 of a local file, only read again if it has changed"""
+        st = os.stat(path)
+        with self.lock:
+            cached = self.hashes.get(path)
+        if cached and cached[:2] == (st.st_mtime, st.st_size):
+            return cached[2]
+        m = hashlib.sha1()
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(65536), ''):
+                m.update(block)
+        with self.lock:
+            self.hashes[path] = (st.st_mtime, st.st_size, m.hexdigest())
+        return m.hexdigest()
+
+    def remote_hashes(self, host, remotedir, pattern='*'):
+        """{name: sha1} of the files matching pattern in remotedir on host"""
+        code, output = self.transport.capture(host, 'cd %s && sha1sum -- %s'
+                                              % (quote(remotedir), pattern))
+        hashes = {}
+        for line in output.splitlines():
+            fields = line.split(None, 1)
+            if len(fields) == 2:
+                hashes[os.path.basename(fields[1].lstrip('*'))] = fields[0]
+        return hashes
+
+    def hostlock(self, host):
+        with self.lock:
+            if not self.locks.has_key(host):
+                self.locks[host] = threading.Lock()
+            return self.locks[host]
+
+    def upload(self, host, contents):
+        """Put the {sha1: local path} contents into the store of host, unless they
+        are there already. Uploads go to a temporary directory first, so the
+        store never holds partial files."""
+        with self.hostlock(host):
+            if not self.stored.has_key(host):
+                code, output = self.transport.capture(host, 'mkdir -p %s && ls %s'
+                                                      % (quote(self.store), quote(self.store)))
+                if code != 0:
+                    return code
+                self.stored[host] = set(output.split())
+            missing = [sha1 for sha1 in contents if sha1 not in self.stored[host]]
+            if not missing:
+                return 0
+            incoming = '%s/.incoming-%s' % (self.store, os.getpid())
+            localdir = tempfile.mkdtemp(prefix='privet-stage-')
+            try:
+                for sha1 in missing:
+                    os.symlink(os.path.abspath(contents[sha1]), os.path.join(localdir, sha1))
+                code = (self.transport.run(host, 'mkdir -p %s' % quote(incoming))
+                        or self.transport.put(host, [os.path.join(localdir, sha1) for sha1 in missing], incoming)
+                        or self.transport.run(host, 'mv %s/* %s/ && rmdir %s'
+                                              % (quote(incoming), quote(self.store), quote(incoming))))
+            finally:
+                shutil.rmtree(localdir, ignore_errors=True)
+            if code == 0:
+                self.stored[host].update(missing)
+                self.count(sum([os.path.getsize(contents[sha1]) for sha1 in missing]))
+            return code
+
+    def stage(self, host, files, remotedir):
+        """Make the local files available in remotedir on host, by links
+        to the store or copies of it. Directories are skipped, as scp
+        without -r did.
+        Returns 0, or the exit code of the failed step."""
+        contents = {}
+        links = []
+        for path in files:
+            if not os.path.isfile(path):
+                continue
+            sha1 = self.sha1(path)
+            contents[sha1] = path
+            src = '%s/%s' % (quote(self.store), sha1)
+            dst = '%s/%s' % (quote(remotedir), quote(os.path.basename(path)))
+            links.append('{ ln -f %s %s 2>/dev/null || { rm -f %s && cp -p %s %s; }; }'
+                         % (src, dst, dst, src, dst))
+        code = self.upload(host, contents)
+        if code != 0:
+            return code
+        return self.transport.run(host, ' && '.join(['mkdir -p ' + quote(remotedir)] + links))
+
+    def fetch(self, host, remotedir, pattern, localdir):
+        """Copy the files matching pattern in remotedir on host to localdir,
+        skipping the ones that are already there with the same contents.
+        Returns 0, or 1 if no file matched."""
+        remote = self.remote_hashes(host, remotedir, pattern)
+        if not remote:
+            return 1
+        for name, sha1 in sorted(remote.iteritems()):
+            local = os.path.join(localdir, name)
+            if os.path.isfile(local) and self.sha1(local) == sha1:
+                continue
+            code = self.transport.get(host, '%s/%s' % (remotedir, name), localdir)
+            if code != 0:
+                return code
+            self.count(os.path.getsize(local))
+        return 0
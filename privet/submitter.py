@@ -1,78 +1,256 @@
 #!/usr/bin/env python2
 
 """
-The batch job submitter. Submits the job to the hosts specified in the .hosts file 
-and launches the job with the specified number of threads.
-Alternatively another input file can be given from command line
+The batch job submitter. Submits the jobs to the hosts specified in the .hosts files
+and launches each job with the specified number of threads.
+Alternatively another input file can be given from command line.
+
+Each line of a hosts file reads 'user@host threads [slots]'. The jobs wait in a
+queue and each host takes the next one whenever one of its slots is free, so
+faster hosts get more of the work. A failed job goes back to the queue to be
+tried on another host. All the commands and copies for a host share one ssh
+connection, see transport.py, and the inputs shared by the jobs are only sent
+once to each host, see staging.py. The state of every job is kept in a state file, so a
+restarted submitter only runs the jobs that are not done yet.
 """
 devnull = open('/dev/null', 'w')
 
-def LaunchJobs(hosts):
-    from multiprocessing import Process
-    from subprocess import call 
-    from progressbar import Bar, ETA, Percentage, ProgressBar
-    from time import sleep 
-
-    call(['mkdir outputtop/'], shell=True, stdout=devnull, stderr=devnull)
-
-    subprocess = []
-    for host in hosts:
-        for i in xrange(5):
-            with open(host, 'r') as file:
-                for n, line in enumerate(file):
-                    line = line.strip()
-                    index = line.find(" ")
-                    subprocess.append(Process(target=LaunchSsh, args=(line[:index], line[index:].strip(),n)))
-    for process in subprocess:
-        process.start()
-    
-    # A 'progress' bar
-    counter = 0
-    widgets = ['Computing on the grid:', Percentage(), ' ', Bar(marker='#', left='[', right=']'), ' ', ETA(), ' ']
-    pbar = ProgressBar(widgets = widgets, maxval=len(subprocess))
-    while counter < len(subprocess):
-        counter = 0
-        sleep(0.5)
-        for process in subprocess:
-            if not process.is_alive():
-                counter += 1
-        pbar.update(counter)
-    pbar.finish()
-
-def LaunchSsh(host, threads, n):
-    from subprocess import call
-
-    call("ssh "+ host + " \' mkdir -p ~/batchJob/" + str(n) + " \'", stdout = devnull, stderr = devnull, shell=True)
-    
-    
-    call(['scp make.py *.cc *.params ' + host + ':~/batchJob/' + str(n)], shell=True , stdout = devnull, stderr = devnull)
-    
-    call(["ssh " + host + " \'  cd ~/batchJob/" + str(n) + "  && ./make.py MC_TOP.cc -P params.params -n 10000 --prefix " + str(n) + " --threads " + threads + "\'"], shell=True, stdout = devnull, stderr = devnull)
-
-    #Copying all the files to the main host:
-    call(["scp " +  host + ":~/batchJob/" + str(n) + "/*.aida outputtop/"], shell=True, stdout = devnull, stderr = devnull)
-
+import os
 import sys
-if sys.version_info[:3] < (2, 4, 0):
-    print 'At least python 2.4 is required to launch this script.'
-    system.exit(1)
+import glob
+import json
+import time
+import threading
+import traceback
+from transport import SshTransport, LocalTransport
+from staging import Stager
+from progress import Tracker
+
+# make.py merges the histograms of a supervised run with the lighthisto of
+# this repository, which the batch hosts don't have
+LIGHTHISTO = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                          '2011-07-aida2yoda', 'pyext', 'lighthisto.py')
+
+class Job(object):
+    """A make.py run in ~/batchJob/<n> on some host"""
+
+    def __init__(self, n, state='pending', attempts=0, host=None, failed=None):
+        self.n = n
+        self.state = state
+        self.attempts = attempts
+        self.host = host
+        # Hosts the job has failed on
+        self.failed = failed or []
+
+    def asDict(self):
+        return {'n': self.n, 'state': self.state, 'attempts': self.attempts,
+                'host': self.host, 'failed': self.failed}
+
+    @classmethod
+    def fromDict(cls, d):
+        return cls(d['n'], d['state'], d['attempts'], d['host'], d['failed'])
+
+class Scheduler(object):
+    """Queue of the jobs, shared by the slot threads of all the hosts.
+
+    Idle slots take the next pending job, preferring the jobs that have not
+    failed on their host yet. A failed job is pending again until it has
+    been tried retries + 1 times. Every change of state is written to the
+    state file."""
+
+    def __init__(self, jobs, nhosts, statefile, retries=2):
+        self.jobs = jobs
+        self.nhosts = nhosts
+        self.statefile = statefile
+        self.retries = retries
+        self.cond = threading.Condition()
+
+    def count(self, state):
+        return len([job for job in self.jobs if job.state == state])
+
+    def save(self):
+        tmpname = self.statefile + '.swp'
+        with open(tmpname, 'w') as out:
+            json.dump({'jobs': [job.asDict() for job in self.jobs]}, out, indent=1)
+        os.rename(tmpname, self.statefile)
+
+    def take(self, host):
+        """Blocks until there is a job for host, returns None when all jobs are over"""
+        with self.cond:
+            while True:
+                for job in self.jobs:
+                    if job.state != 'pending':
+                        continue
+                    if host not in job.failed or len(set(job.failed)) >= self.nhosts:
+                        job.state = 'running'
+                        job.host = host
+                        job.attempts += 1
+                        self.save()
+                        self.cond.notify_all()
+                        return job
+                # Running jobs may still fail and come back to the queue
+                if not self.count('running'):
+                    return None
+                self.cond.wait()
+
+    def finish(self, job, ok):
+        """Record the outcome of a job, returns True if it is over for good"""
+        with self.cond:
+            if ok:
+                job.state = 'done'
+            else:
+                job.failed.append(job.host)
+                if job.attempts > self.retries:
+                    job.state = 'failed'
+                else:
+                    job.state = 'pending'
+            self.save()
+            self.cond.notify_all()
+            return job.state != 'pending'
+
+def load_jobs(statefile, njobs):
+    """Jobs 0 .. njobs-1, with the state of the saved ones. Interrupted and
+    failed jobs are run again"""
+    jobs = {}
+    if os.path.exists(statefile):
+        with open(statefile, 'r') as file:
+            for d in json.load(file)['jobs']:
+                job = Job.fromDict(d)
+                if job.state != 'done':
+                    job = Job(job.n)
+                jobs[job.n] = job
+    for n in xrange(njobs):
+        if not jobs.has_key(n):
+            jobs[n] = Job(n)
+    return [jobs[n] for n in sorted(jobs)]
+
+def read_hosts(hostfiles, slots=1):
+    """(host, threads, slots) for every line of the hosts files"""
+    hosts = []
+    for hostfile in hostfiles:
+        with open(hostfile, 'r') as file:
+            for line in file:
+                fields = line.split()
+                if not fields or fields[0].startswith('#'):
+                    continue
+                threads = len(fields) > 1 and fields[1] or '1'
+                nslots = len(fields) > 2 and int(fields[2]) or slots
+                hosts.append((fields[0], threads, nslots))
+    return hosts
+
+def RunJob(stager, host, threads, job, opts):
+    """Runs a job on host, step by step, returns the exit code of the step that
+    failed or 0"""
+    remotedir = 'batchJob/' + str(job.n)
+    files = ['make.py', 'plugincache.py', LIGHTHISTO] + glob.glob('*.cc') + glob.glob('*.params')
+    command = ('cd %s && rm -f *.aida && ./make.py %s -P %s -n %d --prefix %d --threads %s'
+               % (remotedir, opts.ANALYSIS, opts.PARAMS, opts.EVENTS, job.n, threads))
+    steps = [lambda: stager.stage(host, files, remotedir),
+             lambda: stager.transport.run(host, command),
+             #Copying the new histograms to the main host:
+             lambda: stager.fetch(host, remotedir, '*.aida', opts.OUTPUT)]
+    for step in steps:
+        code = step()
+        if code != 0:
+            return code
+    return 0
+
+def RunSlot(scheduler, stager, tracker, host, threads, opts):
+    while True:
+        job = scheduler.take(host)
+        if job is None:
+            return
+        tracker.started(job.n, host)
+        start = time.time()
+        error = None
+        try:
+            code = RunJob(stager, host, threads, job, opts)
+        except Exception, e:
+            code = -1
+            error = traceback.format_exc()
+            sys.stderr.write('\nJob %d on %s raised an exception:\n%s' % (job.n, host, error))
+        final = scheduler.finish(job, code == 0)
+        tracker.finished(job.n, host, code, time.time() - start, stager.transferred(), final, error)
+
+def LaunchJobs(hostfiles, transport, opts):
+    if not os.path.isdir(opts.OUTPUT):
+        os.makedirs(opts.OUTPUT)
+
+    hosts = read_hosts(hostfiles, opts.SLOTS)
+    if not hosts:
+        print 'No hosts found in ' + ', '.join(hostfiles)
+        sys.exit(1)
+    njobs = opts.JOBS
+    if njobs is None:
+        njobs = 5 * len(hosts)
+    if opts.FRESH and os.path.exists(opts.STATE):
+        os.remove(opts.STATE)
+    jobs = load_jobs(opts.STATE, njobs)
+    scheduler = Scheduler(jobs, len(set(h for h, t, s in hosts)), opts.STATE, opts.RETRIES)
+    stager = Stager(transport)
+    tracker = Tracker(len(jobs), opts.EVENTLOG, done=scheduler.count('done'))
+
+    for host, nthreads, slots in hosts:
+        for i in xrange(slots):
+            tracker.spawn(RunSlot, scheduler, stager, tracker, host, nthreads, opts)
+    # The progress bar follows the events of the slots
+    tracker.follow()
+    tracker.summary()
+
+    failed = [job for job in jobs if job.state == 'failed']
+    for job in failed:
+        print 'Job %d failed on %s' % (job.n, ', '.join(job.failed))
+    return not failed
+
+if sys.version_info[:3] < (2, 6, 0):
+    print 'At least python 2.6 is required to launch this script.'
+    sys.exit(1)
 
 # A bit of parsing:
 from optparse import OptionParser
 parser = OptionParser(usage=__doc__, version='1')
 
 parser.add_option('-f', '--hosts', dest='HOSTS', default=None, help="Specifies a custom hosts file")
+parser.add_option('-j', '--jobs', dest='JOBS', type='int', default=None,
+        help='Number of jobs to run. Default: 5 per host line')
+parser.add_option('-s', '--slots', dest='SLOTS', type='int', default=1,
+        help='Jobs run at the same time on a host without a slots column. Default: 1')
+parser.add_option('-r', '--retries', dest='RETRIES', type='int', default=2,
+        help='Times a failed job is tried again. Default: 2')
+parser.add_option('-a', '--analysis', dest='ANALYSIS', default='MC_TOP.cc',
+        help='Analysis for make.py. Default: MC_TOP.cc')
+parser.add_option('-P', '--params', dest='PARAMS', default='params.params',
+        help='Parameters file for make.py. Default: params.params')
+parser.add_option('-n', '--events', dest='EVENTS', type='int', default=10000,
+        help='Number of events per job. Default: 10000')
+parser.add_option('-o', '--output', dest='OUTPUT', default='outputtop',
+        help='Directory to copy the histograms to. Default: outputtop')
+parser.add_option('--state', dest='STATE', default='.submitter-state',
+        help='File keeping the state of the jobs. Default: .submitter-state')
+parser.add_option('--fresh', dest='FRESH', action='store_true', default=False,
+        help='Forget the saved state and run all the jobs')
+parser.add_option('--local', dest='LOCAL', default=None,
+        help='Run the jobs in LOCAL/<host> directories instead of over ssh')
+parser.add_option('-z', '--compress', dest='COMPRESS', action='store_true', default=False,
+        help='Compress the files copied over ssh')
+parser.add_option('--event-log', dest='EVENTLOG', default='submitter-events.jsonl',
+        help='File to append the job events to, as JSON lines. Default: submitter-events.jsonl')
 (opts, args) = parser.parse_args()
 
-import time
 # Check if the custom hosts file was set by the user, if not, use autodetect
-hosts = []
 if not opts.HOSTS:
-    from glob import glob
-    hosts = glob("*.hosts")
-    LaunchJobs(hosts)
+    hosts = glob.glob("*.hosts")
+else:
+    hosts = [opts.HOSTS]
+
+if opts.LOCAL:
+    transport = LocalTransport(opts.LOCAL)
 else:
-    hosts = [] * 1
-    hosts[0] = opts.HOSTS
-    LauchJobs(hosts)
+    transport = SshTransport(compress=opts.COMPRESS)
 
+try:
+    ok = LaunchJobs(hosts, transport, opts)
+finally:
+    transport.close()
+if not ok:
+    sys.exit(1)
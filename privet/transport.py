@@ -0,0 +1,150 @@
+"""
+Transports for running commands and copying files on the batch hosts.
+
+SshTransport keeps one multiplexed ssh master connection per host open for
+the whole run. All the ssh commands and scp copies to the host go through
+it, so only the first one pays for the connection setup. LocalTransport has
+the same interface but runs the 'remote' commands in a local directory per
+host, to try out the submitters without ssh.
+
+Both transports return the exit codes of the commands (capture() also returns
+their output), and should be closed when the run ends.
+"""
+
+import os
+import glob
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+from subprocess import Popen, PIPE, call
+
+devnull = open('/dev/null', 'w')
+
+class SshTransport(object):
+    """ssh and scp sharing one OpenSSH ControlMaster connection per host.
+
+    The master connection of a host is started by the first command for it,
+    and if it can't be started the commands connect on their own as usual.
+    Remote paths are relative to the home directory on the host. With
+    compress, scp compresses the copies in transit."""
+
+    def __init__(self, timeout=30, compress=False):
+        self.timeout = timeout
+        self.compress = compress
+        # Socket paths are limited to about 100 characters, so keep them short
+        self.controldir = tempfile.mkdtemp(prefix='ssh-')
+        self.masters = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def controlpath(self, host):
+        return os.path.join(self.controldir, hashlib.md5(host).hexdigest()[:12])
+
+    def options(self, host):
+        return ['-o', 'ControlPath=' + self.controlpath(host), '-o', 'ControlMaster=no']
+
+    def connect(self, host):
+        """Start the master connection for host, unless there is one already"""
+        with self.lock:
+            if not self.locks.has_key(host):
+                self.locks[host] = threading.Lock()
+            hostlock = self.locks[host]
+        with hostlock:
+            if self.masters.has_key(host):
+                return
+            path = self.controlpath(host)
+            master = Popen(['ssh', '-M', '-N', '-o', 'ControlPath=' + path,
+                            '-o', 'BatchMode=yes', '-o', 'ServerAliveInterval=60', host],
+                           stdin=devnull, stdout=devnull, stderr=devnull)
+            deadline = time.time() + self.timeout
+            while not os.path.exists(path) and master.poll() is None and time.time() < deadline:
+                time.sleep(0.1)
+            if not os.path.exists(path) and master.poll() is None:
+                master.terminate()
+                master.wait()
+            self.masters[host] = master
+
+    def run(self, host, command):
+        self.connect(host)
+        return call(['ssh'] + self.options(host) + [host, command], stdout=devnull, stderr=devnull)
+
+    def capture(self, host, command):
+        """Exit code and standard output of command"""
+        self.connect(host)
+        process = Popen(['ssh'] + self.options(host) + [host, command], stdout=PIPE, stderr=devnull)
+        output = process.communicate()[0]
+        return process.returncode, output
+
+    def scp(self, host):
+        return ['scp', '-p'] + (self.compress and ['-C'] or []) + self.options(host)
+
+    def put(self, host, files, remotedir):
+        self.connect(host)
+        return call(self.scp(host) + files + ['%s:%s/' % (host, remotedir)],
+                    stdout=devnull, stderr=devnull)
+
+    def get(self, host, remotefiles, localdir):
+        self.connect(host)
+        return call(self.scp(host) + ['%s:%s' % (host, remotefiles), localdir],
+                    stdout=devnull, stderr=devnull)
+
+    def close(self):
+        """Close all the master connections"""
+        with self.lock:
+            for host, master in self.masters.iteritems():
+                if master.poll() is None:
+                    call(['ssh', '-O', 'exit', '-o', 'ControlPath=' + self.controlpath(host), host],
+                         stdout=devnull, stderr=devnull)
+                    if master.poll() is None:
+                        master.terminate()
+                    master.wait()
+            self.masters.clear()
+        shutil.rmtree(self.controldir, ignore_errors=True)
+
+class LocalTransport(object):
+    """Stand-in for SshTransport that runs the 'remote' commands in a local
+    directory for each host, <root>/<host>"""
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def hostdir(self, host):
+        path = os.path.join(self.root, host)
+        try:
+            os.makedirs(path)
+        except OSError, e:
+            if not os.path.isdir(path):
+                raise
+        return path
+
+    def run(self, host, command):
+        return call(['sh', '-c', command], cwd=self.hostdir(host), stdout=devnull, stderr=devnull)
+
+    def capture(self, host, command):
+        process = Popen(['sh', '-c', command], cwd=self.hostdir(host), stdout=PIPE, stderr=devnull)
+        output = process.communicate()[0]
+        return process.returncode, output
+
+    def put(self, host, files, remotedir):
+        try:
+            for f in files:
+                shutil.copy2(f, os.path.join(self.hostdir(host), remotedir))
+        except (IOError, OSError), e:
+            return 1
+        return 0
+
+    def get(self, host, remotefiles, localdir):
+        paths = glob.glob(os.path.join(self.hostdir(host), remotefiles))
+        if not paths:
+            return 1
+        try:
+            for path in paths:
+                shutil.copy2(path, localdir)
+        except (IOError, OSError), e:
+            return 1
+        return 0
+
+    def close(self):
+        pass